@@ -66,6 +66,21 @@ def rewind(f, basic_header):
   bytes_in_header = basic_header['bytes in header']
   f.seek(bytes_in_header, 0) #we are now positioned at the start of the data packets
 
+def memmap_data(fname, mode = 'r'):
+  """Memory map the data of an .NSx file as a (samples x channels) array, so
+  we can get at any stretch of any channel without reading the file in. Returns
+  the basic header and the array (None, None if the file is not NSx 2.1)"""
+  f = open(fname, 'rb')
+  basic_header = read_basic_header(f)
+  f.close()
+  if basic_header is None:
+    return None, None
+  data = numpy.memmap(fname, dtype = basic_header['waveform format'], mode = mode,
+                      offset = basic_header['bytes in header'],
+                      shape = (basic_header['samples per channel'],
+                               basic_header['number of channels']))
+  return basic_header, data
+
 def length_of_lfp(basic_header, t_dur_ms):
   """Utility function - given the time of the lfp trace we want, return how many
   samples it will have"""
@@ -3,6 +3,8 @@ eye position data stored in lablib files"""
 
 import logging
 import pylab
+from itertools import chain
+from neurapy.utility.ragged import RaggedArray, from_list, range_index
 
 logger = logging.getLogger('Eye')
 
@@ -104,55 +106,110 @@ def fix_window(R):
     
   return fix_w
 
-def raw_eye_xy(R, old_format = None):
-  """Return the raw x,y data points without calibration for diagnostic purposes."""
-  if dat_format is None:
-    dvx = R.data['Trials']['eyeXData']['Data Values']  
-    dvy = R.data['Trials']['eyeYData']['Data Values']
-  elif dat_format == 'fixate':
+def flatten_packets(dv):
+  """Concatenate the packets of each trial of an eye data field into one
+  contiguous array.
+  Input:
+   dv - ['Data Values'] of an eye data event, either the lists of lists from
+        LLDataFileReader or an LLColumn from LLColumnarReader
+  Output:
+   values - all the samples, as float
+   offsets - the samples of trial tr are values[offsets[tr]:offsets[tr+1]]
+   n_packets - number of packets in each trial"""
+  if hasattr(dv, 'value_offsets'): #LLColumn, already contiguous
+    offsets = dv.value_offsets()
+    values = pylab.asarray(dv.values[offsets[0]:offsets[-1]], dtype=float)
+    return values, offsets - offsets[0], dv.events_per_trial()
+
+  n_packets = pylab.array([len(trial) for trial in dv], dtype=int)
+  counts = pylab.array([sum(len(pak) for pak in trial) for trial in dv], dtype=int)
+  offsets = pylab.concatenate(([0], pylab.cumsum(counts)))
+  values = pylab.fromiter(chain.from_iterable(chain.from_iterable(dv)), dtype=float, count=offsets[-1])
+  return values, offsets, n_packets
+
+def deinterleave_packets(dv):
+  """Split the old format eyeData, where each packet holds x,y,x,y..., into
+  contiguous x and y arrays (see flatten_packets)"""
+  values, offsets, n_packets = flatten_packets(dv)
+  #Position of each sample within its packet decides if it is x or y
+  if hasattr(dv, 'value_offsets'):
+    eo = dv.event_offsets[dv.trial_offsets[0]:dv.trial_offsets[-1]+1]
+  else:
+    eo = pylab.concatenate(([0], pylab.cumsum([len(pak) for trial in dv for pak in trial])))
+  eo = eo - eo[0]
+  pos = pylab.arange(values.size) - pylab.repeat(eo[:-1], pylab.diff(eo))
+  is_x = (pos % 2) == 0
+  trial = pylab.repeat(pylab.arange(offsets.size - 1), pylab.diff(offsets))
+  n_trials = offsets.size - 1
+  x_off = pylab.concatenate(([0], pylab.cumsum(pylab.bincount(trial[is_x], minlength=n_trials))))
+  y_off = pylab.concatenate(([0], pylab.cumsum(pylab.bincount(trial[~is_x], minlength=n_trials))))
+  return values[is_x], x_off, values[~is_x], y_off, n_packets
+
+def eye_samples(R, old_format = False):
+  """The raw (uncalibrated) eye samples of all trials, as contiguous arrays.
+  Trials where x and y have a different number of samples are truncated to
+  the shorter of the two.
+  Inputs:
+    R - lablib data structure from reader (LLDataFileReader or
+        LLColumnarReader)
+    old_format - if True the eye xy is interleaved in eyeData (see eye_xy)
+  Outputs:
+    x, y - all the samples, as float
+    offsets - the samples of trial tr are x[offsets[tr]:offsets[tr+1]]"""
+  if not old_format:
+    x, x_off, x_pak = flatten_packets(R.data['Trials']['eyeXData']['Data Values'])
+    y, y_off, y_pak = flatten_packets(R.data['Trials']['eyeYData']['Data Values'])
+    for tr in pylab.flatnonzero(x_pak != y_pak):
+      logger.warning('eye_samples: trial %d : unequal number of packets x=%d y=%d' %(tr, x_pak[tr], y_pak[tr]))
+  else:
     #Annoying old format
-    dvxy = R.data['Trials']['eyeData']['Data Values']
-    n_trials = len(dvxy)
-    dvx = []
-    dvy = []
-    for tr in range(n_trials):
-      dvx_tr = []
-      dvy_tr = []
-      for pak in range(len(dvxy[tr])):
-        dvx_tr.append(dvxy[tr][pak][::2])
-        dvy_tr.append(dvxy[tr][pak][1::2])
-      dvx.append(dvx_tr)
-      dvy.append(dvy_tr)
+    x, x_off, y, y_off, n_packets = deinterleave_packets(R.data['Trials']['eyeData']['Data Values'])
 
-  n_trials = len(dvx)
-  
-  all_x = []
-  all_y = []
-  for tr in range(n_trials):
-    raw_x = []
-    raw_y = []
-    for pak in range(len(dvx[tr])):
-      raw_x += dvx[tr][pak]
-    for pak in range(len(dvy[tr])):
-      raw_y += dvy[tr][pak]
-      
-    if len(dvx[tr]) != len(dvy[tr]):
-      print 'eye.eye_xy: trial %d : unequal number of packets x=%d y=%d' %(tr, len(dvx[tr]), len(dvy[tr]))
-    
-    uncal_x = pylab.array(raw_x, dtype=float)
-    uncal_y = pylab.array(raw_y, dtype=float)
-    
-    if uncal_x.size != uncal_y.size:
-      print 'eye.eye_xy: trial %d : unequal number of samples x=%d y=%d' %(tr, uncal_x.size, uncal_y.size)
-      minnsamp = min(uncal_x.size, uncal_y.size)
-      uncal_x = uncal_x[:minnsamp]
-      uncal_y = uncal_y[:minnsamp]
-    
-    all_x.append(pylab.array(uncal_x, dtype=float))
-    all_y.append(pylab.array(uncal_y, dtype=float))
-                 
-  return all_x, all_y
-  
+  nx = pylab.diff(x_off)
+  ny = pylab.diff(y_off)
+  if (nx != ny).any():
+    for tr in pylab.flatnonzero(nx != ny):
+      logger.warning('eye_samples: trial %d : unequal number of samples x=%d y=%d' %(tr, nx[tr], ny[tr]))
+    n = pylab.minimum(nx, ny)
+    x = x[RaggedArray(x, x_off).position() < pylab.repeat(n, nx)]
+    y = y[RaggedArray(y, y_off).position() < pylab.repeat(n, ny)]
+    x_off = pylab.concatenate(([0], pylab.cumsum(n)))
+  return x, y, x_off
+
+def calibrate(x, y, offsets, M, C):
+  """Apply the per trial calibration to all the samples in one go.
+  Inputs:
+    x, y, offsets - as returned by eye_samples
+    M, C - as returned by eye_calibrations
+  Outputs:
+    cal_x, cal_y - calibrated samples
+
+  The formula that John uses for the calibration is (counter to matrix notation)
+   x = m_11 x + m_21 y + tx
+   y = m_12 x + m_22 y + ty
+  Note the back-diagonal terms are flipped! With our M (see eye_calibrations)
+  this is xy_cal[j] = sum_i M[i,j] xy[i] + C[j]"""
+  tid = pylab.repeat(pylab.arange(offsets.size - 1), pylab.diff(offsets))
+  xy = pylab.einsum('nij,ni->nj', M[tid], pylab.column_stack((x, y))) + C[tid]
+  return xy[:,0], xy[:,1]
+
+def eye_xy_ragged(R, M, C, old_format = False):
+  """Calibrated eye position for all trials as RaggedArrays. Inputs as for
+  eye_xy. X.data holds all the samples of the session, X[tr] is a view of the
+  samples of trial tr"""
+  x, y, offsets = eye_samples(R, old_format)
+  cal_x, cal_y = calibrate(x, y, offsets, M, C)
+  return RaggedArray(cal_x, offsets), RaggedArray(cal_y, offsets)
+
+def raw_eye_xy(R, old_format = None):
+  """Return the raw x,y data points without calibration for diagnostic purposes.
+  old_format - if set (e.g. to 'fixate') read the old eyeData format
+  Outputs:
+    all_x - list of arrays of the eyeposition for each trial
+    all_y - list of arrays of the eyeposition for each trial
+  The arrays are views into one contiguous array per axis"""
+  x, y, offsets = eye_samples(R, bool(old_format))
+  return RaggedArray(x, offsets).tolist(), RaggedArray(y, offsets).tolist()
   
 def eye_xy(R, M, C, old_format = False):
   """Give us eye position data for each trial.
@@ -166,62 +223,10 @@ def eye_xy(R, M, C, old_format = False):
   Outputs:
     all_x - list of arrays of the eyeposition for each trial
     all_y - list of arrays of the eyeposition for each trial
+  The arrays are views into one contiguous array per axis (see eye_xy_ragged)
   """
-  if not old_format:
-    dvx = R.data['Trials']['eyeXData']['Data Values']  
-    dvy = R.data['Trials']['eyeYData']['Data Values']
-  else:
-    #Annoying old format
-    dvxy = R.data['Trials']['eyeData']['Data Values']
-    n_trials = len(dvxy)
-    dvx = []
-    dvy = []
-    for tr in range(n_trials):
-      dvx_tr = []
-      dvy_tr = []
-      for pak in range(len(dvxy[tr])):
-        dvx_tr.append(dvxy[tr][pak][::2])
-        dvy_tr.append(dvxy[tr][pak][1::2])
-      dvx.append(dvx_tr)
-      dvy.append(dvy_tr)
-
-  n_trials = len(dvx)
-  
-  all_x = []
-  all_y = []
-  for tr in range(n_trials):
-    raw_x = []
-    raw_y = []
-    for pak in range(len(dvx[tr])):
-      raw_x += dvx[tr][pak]
-    for pak in range(len(dvy[tr])):
-      raw_y += dvy[tr][pak]
-      
-    if len(dvx[tr]) != len(dvy[tr]):
-      print 'eye.eye_xy: trial %d : unequal number of packets x=%d y=%d' %(tr, len(dvx[tr]), len(dvy[tr]))
-    
-    uncal_x = pylab.array(raw_x, dtype=float)
-    uncal_y = pylab.array(raw_y, dtype=float)
-    
-    if uncal_x.size != uncal_y.size:
-      print 'eye.eye_xy: trial %d : unequal number of samples x=%d y=%d' %(tr, uncal_x.size, uncal_y.size)
-      minnsamp = min(uncal_x.size, uncal_y.size)
-      uncal_x = uncal_x[:minnsamp]
-      uncal_y = uncal_y[:minnsamp]
-
-    #The formula that John uses for the calibration is (counter to matrix notation)
-    # x = m_11 x + m_21 y + tx
-    # y = m_12 x + m_22 y + ty 
-    # Note the back-diagonal terms are flipped!
-    #x = M[tr,0,0]*uncal_x + M[tr,0,1]*uncal_y + C[tr,0]#WRONG CODE!
-    #y = M[tr,1,0]*uncal_x + M[tr,1,1]*uncal_y + C[tr,1]
-    x = M[tr,0,0]*uncal_x + M[tr,1,0]*uncal_y + C[tr,0]
-    y = M[tr,0,1]*uncal_x + M[tr,1,1]*uncal_y + C[tr,1]
-      
-    all_x.append(pylab.array(x, dtype=float))
-    all_y.append(pylab.array(y, dtype=float))
-                 
-  return all_x, all_y
+  X, Y = eye_xy_ragged(R, M, C, old_format)
+  return X.tolist(), Y.tolist()
 
 def eye_xy_selected(all_x, all_y, trial_no, start_ms, stop_ms, f_samp = 200.0):
   """For the given trial give us the eye samples between the start_ms and stop_ms
@@ -281,22 +286,80 @@ def fixation_box_dwell_times(R):
     dwell_times[tr,:] = [st, nd] 
   return dwell_times
   
-def fixation_box_samples(all_x, all_y, fix_w, dwell_times, f_samp = 200.0):
+def fixation_box_indexes(n_samples, dwell_times, f_samp = 200.0):
+  """Start and stop index (within each trial) of the samples for which the eye
+  is in the fixation box, computed for all trials at once. The samples are
+  x[tr][start[tr]:stop[tr]] and the indexes follow python slice rules (an end
+  of -1, i.e. no saccade, drops the last sample). Trials with no fixation get
+  start == stop.
+  Inputs:
+    n_samples - number of eye samples in each trial
+    dwell_times - from fixation_box_dwell_times
+    f_samp - eye sampling rate (Hz)"""
+  n_samples = pylab.asarray(n_samples, dtype=int)
+  fixated = dwell_times[:,0] >= 0
+  start = (f_samp * dwell_times[:,0]/1000.0).astype(int)
+  stop = pylab.where(dwell_times[:,1] >= 0, (f_samp * dwell_times[:,1]/1000.0).astype(int) - 5, -1)
+  #Python slice semantics
+  start = pylab.where(start < 0, pylab.maximum(start + n_samples, 0), pylab.minimum(start, n_samples))
+  stop = pylab.where(stop < 0, pylab.maximum(stop + n_samples, 0), pylab.minimum(stop, n_samples))
+  start[~fixated] = 0
+  stop = pylab.where(fixated, pylab.maximum(stop, start), 0)
+  return start, stop
+
+def fixation_box_samples(all_x, all_y, fix_w, dwell_times, f_samp = 200.0, stats = False):
   """Collect all x and ys for all trials for when the eye is within the fixation
-  box."""
-  n_trials = len(all_x)
-  in_fix_box_x = pylab.array([],dtype=float)
-  in_fix_box_y = pylab.array([],dtype=float)
-  for tr in range(n_trials):
-    if dwell_times[tr,0] >= 0:
-      # We got a fixation
-      start_idx = int(f_samp * dwell_times[tr,0]/1000.0)
-      end_idx = -1
-      if dwell_times[tr,1] >= 0:
-        end_idx = int(f_samp * dwell_times[tr,1]/1000.0) - 5
-      in_fix_box_x = pylab.concatenate((in_fix_box_x, all_x[tr][start_idx:end_idx]))
-      in_fix_box_y = pylab.concatenate((in_fix_box_y, all_y[tr][start_idx:end_idx]))
-  return in_fix_box_x, in_fix_box_y    
+  box.
+  Inputs:
+    all_x, all_y - eye position, as lists of arrays (eye_xy) or RaggedArrays
+                   (eye_xy_ragged)
+    fix_w - fixation window (unused)
+    dwell_times - from fixation_box_dwell_times
+    f_samp - eye sampling rate (Hz)
+    stats - if True also return per trial fixation statistics
+  Outputs:
+    in_fix_box_x, in_fix_box_y - the samples of all the trials, concatenated
+    fix_stats - (only if stats is True) dictionary of per trial arrays
+      'n' - number of samples
+      'mean x', 'mean y' - mean eye position
+      'dispersion' - rms distance of the samples from the mean position
+      'drift x', 'drift y' - slope of a straight line fit to the position (deg/s)
+      Trials without samples get nan"""
+  if not isinstance(all_x, RaggedArray):
+    all_x = from_list(all_x, dtype=float)
+  if not isinstance(all_y, RaggedArray):
+    all_y = from_list(all_y, dtype=float)
+  start, stop = fixation_box_indexes(all_y.lengths(), dwell_times, f_samp)
+  idx, n = range_index(all_y.offsets[:-1] + start, all_y.offsets[:-1] + stop)
+  in_fix_box_y = all_y.data[idx]
+  start, stop = fixation_box_indexes(all_x.lengths(), dwell_times, f_samp)
+  idx, n = range_index(all_x.offsets[:-1] + start, all_x.offsets[:-1] + stop)
+  in_fix_box_x = all_x.data[idx]
+  if not stats:
+    return in_fix_box_x, in_fix_box_y
+
+  n_trials = n.size
+  tid = pylab.repeat(pylab.arange(n_trials), n)
+  t = (pylab.arange(n.sum()) - pylab.repeat(pylab.cumsum(n) - n, n))/f_samp
+  def trial_sum(w):
+    return pylab.bincount(tid, weights=w, minlength=n_trials)
+  with pylab.errstate(invalid='ignore', divide='ignore'):
+    mx = trial_sum(in_fix_box_x)/n
+    my = trial_sum(in_fix_box_y)/n
+    dx = in_fix_box_x - mx[tid]
+    dy = in_fix_box_y - my[tid]
+    dispersion = pylab.sqrt(trial_sum(dx**2 + dy**2)/n)
+    dt = t - (trial_sum(t)/n)[tid]
+    stt = trial_sum(dt**2)
+    fix_stats = {
+      'n': n,
+      'mean x': mx,
+      'mean y': my,
+      'dispersion': dispersion,
+      'drift x': trial_sum(dt*dx)/stt,
+      'drift y': trial_sum(dt*dy)/stt
+    }
+  return in_fix_box_x, in_fix_box_y, fix_stats
   
   
 def plot_eye_pos(trial_no, all_x, all_y, fix_w, dwell_times, f_samp = 200.0):
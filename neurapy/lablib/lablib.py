@@ -38,6 +38,16 @@ R = lablib.LLDataFileReader(fname = "dj-2008-11-10-01.dat", endian = '>')
 #To force littleendian
 R = lablib.LLDataFileReader(fname = "dj-2008-11-10-01.dat", endian = '<')
 
+#To store the data as arrays rather than lists of lists (much faster and 
+#smaller, see LLColumnarReader)
+R = lablib.LLColumnarReader(fname = "dj-2008-11-10-01.dat")
+
+#Rather than pickle the arrays, save them as a session, which loads almost
+#instantly and memory maps each field only when it is used (see session.py)
+from neurapy.lablib import session
+session.convert(fname = "dj-2008-11-10-01.dat", ignore_eye_data = False)
+R = session.load_session("dj-2008-11-10-01-eye.session")
+
 Dictionary structure:
 "Header"
     "File Name" - the name of the file
@@ -103,6 +113,16 @@ import cPickle
 import glob
 #Needed for directory listing for pickle_all
 
+import pylab
+#Needed for the array storage used by LLColumnarReader
+
+import numpy
+#Needed to save and load the event index of LLIndexedFile
+
+import hashlib, json, time, multiprocessing
+#Needed by convert_all to keep track of converted files and to convert them in
+#parallel
+
 # Stateless functions --------------------------------------------------------
 #These functions just require a file pointer, and not any complex state 
 #information
@@ -130,8 +150,15 @@ def readLLNumeric(f, fmt):
   Output:
   Number
   """
+  fmt = standard_endian(fmt[:1]) + fmt[1:] if fmt[:1] in '<>=!@' else '=' + fmt
   return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
 
+def standard_endian(endian):
+  """struct/numpy byte order prefix with standard sizes. With '' or '@' (native)
+  struct uses the native sizes, and a 'long' is 8 bytes on 64 bit Linux, while
+  lablib longs are always 4 bytes"""
+  return {'': '=', '@': '='}.get(endian, endian)
+
 def readLLDataEventDef(f, endian = '', root = False):
   """Read in and return a dictionary corresponding to a lablib dataevent 
   definition found in the header
@@ -291,6 +318,21 @@ def append_new_data_dict_trial(data_dict):
       #Append an empty list for this trial
       data_dict[key].append([])
 
+def event_code_format(file_header):
+  """Format of the event codes in the file"""
+  #LLDataFileReader.m:728
+  #The size of the eventCode depends on the number of events
+  #LLDataDoc.m:279. 
+  #charCode = unsigned char,
+  #shortCode = unsigned short
+  #eventCode = long
+  event_code_fmt = 'b'  
+  if len(file_header["Events"]) > 0xff:
+    event_code_fmt = 'H'
+  if len(file_header["Events"]) > 0xffff:
+    event_code_fmt = 'l'
+  return event_code_fmt
+
 def read_llevent_code_from_file(f, event_code_fmt):
   """This 'read ahead' is needed because what the event is often decides where
   it should go"""
@@ -314,7 +356,7 @@ def skip_llevent_from_file(f, event_code, event_data_def_by_code, endian):
     #Variable length data, figure it out LLDataFileReader.m:774
     numBytes = readLLNumeric(f, endian + 'L')
   f.seek(numBytes,1)
-  f.seek(struct.calcsize('L'),1)
+  f.seek(struct.calcsize('=L'),1)
     
 def read_llevent_from_file(f, event_code, event_data_def_by_code, endian):
   """Read an event from the file.
@@ -436,7 +478,7 @@ class LLDataFileReader:
     ignore_events should be a list of strings"""
     
     self.ignore_events = ignore_events
-    self.endian = endian
+    self.endian = standard_endian(endian)
     
     self.data = {}
     data = self.data
@@ -447,9 +489,9 @@ class LLDataFileReader:
     #definitions
     data['Header'], data_dict_template = readLLHeader(f, self.endian)
     
-    self.data['Trials'] = copy.deepcopy(data_dict_template)
-    self.data['Experiment Header'] = copy.deepcopy(data_dict_template)
-    self.data['Junk Events'] = copy.deepcopy(data_dict_template)
+    self.data['Trials'] = self.new_data_dict(data_dict_template)
+    self.data['Experiment Header'] = self.new_data_dict(data_dict_template)
+    self.data['Junk Events'] = self.new_data_dict(data_dict_template)
     
     #Initialize things according to the header etc.
     self.set_state()
@@ -458,7 +500,7 @@ class LLDataFileReader:
     #represents experiment parameters etc. that don't change over the file
 
     data_dict = self.data['Experiment Header']
-    append_new_data_dict_trial(data_dict)
+    self.new_trial(data_dict)
     #event_code = self.read_and_append_llevent(f, data_dict)
     event_code = read_llevent_code_from_file(f, self.event_code_fmt)
     while event_code != self.trialStart_code and event_code is not None:
@@ -468,7 +510,7 @@ class LLDataFileReader:
     #Read in trial events
     data_dict = self.data['Trials']
     data_dict_jnk = self.data['Junk Events']
-    append_new_data_dict_trial(data_dict_jnk)
+    self.new_trial(data_dict_jnk)
     n_trials = 0
     trial_properly_closed = True
     while event_code is not None:
@@ -479,7 +521,7 @@ class LLDataFileReader:
         event_code = read_llevent_code_from_file(f, self.event_code_fmt)
       
       if event_code is not None:
-        append_new_data_dict_trial(data_dict) #New trial starts
+        self.new_trial(data_dict) #New trial starts
       while event_code != self.trialEnd_code and event_code is not None:
         trial_properly_closed = False
         if event_code not in self.ignore_event_codes:
@@ -500,6 +542,19 @@ class LLDataFileReader:
         break
     
     f.close()
+    self.finish()
+
+  def new_data_dict(self, data_dict_template):
+    """Return an empty data_dict, in which we will store the events of one section of the file"""
+    return copy.deepcopy(data_dict_template)
+
+  def new_trial(self, data_dict):
+    """Prep the data_dict to receive a new trial"""
+    append_new_data_dict_trial(data_dict)
+
+  def finish(self):
+    """Called when we are done reading the file"""
+    pass
         
   def set_state(self):
     """This function takes the file_header structure (as returned by 
@@ -519,17 +574,7 @@ class LLDataFileReader:
         else:
           logger.warning('Told to ignore event %s which does not exist' %(self.ignore_events[n]))
 
-    #LLDataFileReader.m:728
-    #The size of the eventCode depends on the number of events
-    #LLDataDoc.m:279. 
-    #charCode = unsigned char,
-    #shortCode = unsigned short
-    #eventCode = long
-    self.event_code_fmt = 'b'  
-    if len(file_header["Events"]) > 0xff:
-      self.event_code_fmt = 'H'
-    if len(file_header["Events"]) > 0xffff:
-      self.event_code_fmt = 'l'
+    self.event_code_fmt = event_code_format(file_header)
 
     #Some important event codes (speeds up ops by avoiding string comparisons and
     #repeated dictionary look ups)
@@ -634,8 +679,9 @@ class LLDataFileReader:
       self.lastSampleTime[channel] += self.sampleIntervalMS
     elif event_code == self.spike_code:
       #LLStandardDataEvents.h:11 - TimestampData is composed of a 
-      #short ('channel') and long ('time')
-      timeStamp = struct.unpack(endian + 'hl', event_data_buffer)[1] 
+      #short ('channel') and long ('time'). The long is the last 4 bytes, whether
+      #or not the struct was padded
+      timeStamp = struct.unpack(endian + 'l', event_data_buffer[-4:])[0]
       trial_time = self.spikeStartTime - self.trialStartTime + timeStamp
     elif event_code == self.spike0_code:
       theTime = struct.unpack(endian + 'l', event_data_buffer)[0]
@@ -703,6 +749,402 @@ class LLDataFileReader:
     self.data = cPickle.load(f)
     f.close()
 
+# Columnar storage -----------------------------------------------------------
+#LLColumnarReader reads the file in the same way as LLDataFileReader, but
+#instead of lists of lists it accumulates each leaf of the data tree into one
+#typed array, with offsets arrays marking where each event and each trial start
+#(a ragged, or CSR, layout). This is much faster to build, takes a fraction of
+#the memory and pickles much faster.
+
+#lablib data types to numpy types. Strings are kept as one python string per
+#event in an object array
+lltype_to_dtype = {'short': 'i2',
+                   'unsigned short': 'u2',
+                   'long': 'i4',
+                   'unsigned long': 'u4',
+                   'double': 'f8',
+                   'float': 'f4',
+                   'boolean': 'i1'}
+
+class GrowableArray:
+  """An array we can append to, with amortized doubling of the storage."""
+  def __init__(self, dtype, capacity = 256):
+    self.buf = pylab.empty(capacity, dtype = dtype)
+    self.n = 0
+
+  def reserve(self, k):
+    if self.n + k > self.buf.size:
+      new_buf = pylab.empty(max(2*self.buf.size, self.n + k), dtype = self.buf.dtype)
+      new_buf[:self.n] = self.buf[:self.n]
+      self.buf = new_buf
+
+  def append(self, x):
+    self.reserve(1)
+    self.buf[self.n] = x
+    self.n += 1
+
+  def extend(self, x):
+    k = len(x)
+    self.reserve(k)
+    self.buf[self.n:self.n + k] = x
+    self.n += k
+
+  def array(self):
+    """Return a trimmed copy of the data"""
+    return self.buf[:self.n].copy()
+
+class LLColumn:
+  """One leaf of the data tree (e.g. ['Trials']['eyeXData']['Data Values'])
+  stored as arrays:
+    values - all the values of all the events of all the trials, in file order
+    event_offsets - the values of event e are values[event_offsets[e]:event_offsets[e+1]]
+    trial_offsets - the events of trial t are events trial_offsets[t] to trial_offsets[t+1]
+  For 'Absolute Time' and 'Trial Time' there is exactly one value per event 
+  (scalar = True) and event_offsets is None.
+
+  Indexing behaves like the lists of lists LLDataFileReader returns: C[t] is
+  a list with one array (a view into values) per event in trial t, or, for
+  scalar columns, the array of values in trial t. trial_values(t) returns all
+  the values of trial t as one array, without copying."""
+  def __init__(self, values, event_offsets, trial_offsets, scalar = False):
+    self.values = values
+    self.event_offsets = event_offsets
+    self.trial_offsets = trial_offsets
+    self.scalar = scalar
+
+  def __len__(self):
+    return self.trial_offsets.size - 1
+
+  def __getitem__(self, tr):
+    if tr < 0:
+      tr += len(self)
+    if tr < 0 or tr >= len(self):
+      raise IndexError('trial index out of range')
+    e0, e1 = self.trial_offsets[tr], self.trial_offsets[tr+1]
+    if self.scalar:
+      return self.values[e0:e1]
+    eo = self.event_offsets
+    return [self.values[eo[e]:eo[e+1]] for e in xrange(e0, e1)]
+
+  def value_offsets(self):
+    """Offsets into values of the start of each trial (n_trials + 1 long)"""
+    if self.scalar:
+      return self.trial_offsets
+    return self.event_offsets[self.trial_offsets]
+
+  def trial_values(self, tr):
+    """All the values of trial tr as one array (a view)"""
+    vo = self.value_offsets()
+    return self.values[vo[tr]:vo[tr+1]]
+
+  def events_per_trial(self):
+    return pylab.diff(self.trial_offsets)
+
+class ColumnBuilder:
+  """Accumulates the data for one LLColumn as we read the file"""
+  def __init__(self, dtype, scalar = False):
+    self.scalar = scalar
+    self.values = GrowableArray(dtype)
+    self.counts = None if scalar else GrowableArray('i8') #values per event
+    self.trials = GrowableArray('i4') #trial of each event
+
+  def append(self, values, trial):
+    self.values.extend(values)
+    self.counts.append(len(values))
+    self.trials.append(trial)
+
+  def append_scalar(self, value, trial):
+    self.values.append(value)
+    self.trials.append(trial)
+
+  def column(self, n_trials):
+    trial_offsets = pylab.searchsorted(self.trials.array(), pylab.arange(n_trials + 1))
+    if self.scalar:
+      event_offsets = None
+    else:
+      event_offsets = pylab.concatenate(([0], pylab.cumsum(self.counts.array())))
+    return LLColumn(self.values.array(), event_offsets, trial_offsets, self.scalar)
+
+def column_tree(event_def, root = False):
+  """Mirror of the data_dict readLLDataEventDef builds, but with 
+  ColumnBuilders at the leaves"""
+  data_dict = {}
+  if root:
+    data_dict['Absolute Time'] = ColumnBuilder('i8', scalar = True)
+    data_dict['Trial Time'] = ColumnBuilder('i8', scalar = True)
+  if event_def["typeName"] == "struct":
+    for key, child in event_def["Children"].items():
+      data_dict[key] = column_tree(child)
+  else:
+    dtype = lltype_to_dtype.get(event_def["typeName"], object)
+    if root and event_def["dataName"] == 'text':
+      dtype = object
+    if root:
+      if event_def["typeName"] != 'no data':
+        data_dict['Data Values'] = ColumnBuilder(dtype)
+    else:
+      data_dict = ColumnBuilder(dtype)
+  return data_dict
+
+def leaf_plan(event_def, tree, endian, base_offset = 0, plan = None):
+  """Flatten the (nested) event definition into a list of leaves 
+  (builder, offset, elements, elementBytes, dtype) with offsets measured from
+  the start of the event data buffer, so that we can decode an event without
+  recursing. This mirrors the offset logic of recurse_into_data_dict"""
+  if plan is None:
+    plan = []
+  if event_def["typeName"] != "struct":
+    if event_def["elementBytes"]:
+      dtype = lltype_to_dtype.get(event_def["typeName"])
+      if dtype is not None:
+        dtype = pylab.dtype(endian + dtype)
+      plan.append((tree, base_offset + event_def["offsetBytes"], event_def["elements"], 
+                   event_def["elementBytes"], dtype))
+  else:
+    offset = base_offset + event_def["offsetBytes"]
+    for key, child in event_def["Children"].items():
+      leaf_plan(child, tree[key], endian, offset, plan)
+  return plan
+
+class ColumnSection(dict):
+  """The data tree for one section of the file (e.g. 'Trials') while we are 
+  reading it. trial is the index of the current trial"""
+  def __init__(self, events, endian = ''):
+    dict.__init__(self)
+    for event_def in events.values():
+      self[event_def['dataName']] = column_tree(event_def, root = True)
+    self.endian = standard_endian(endian)
+    self.trial = -1
+    self.plans = {}
+
+  def append_event(self, event_code, event_def, absolute_time, trial_time, event_data_buffer):
+    event = self[event_def['dataName']]
+    trial = self.trial
+    event['Absolute Time'].append_scalar(absolute_time, trial)
+    event['Trial Time'].append_scalar(trial_time, trial)
+    if event_def['dataName'] == 'text':
+      event['Data Values'].append([event_data_buffer], trial)
+      return
+
+    if event_code not in self.plans:
+      if event_def["typeName"] == "struct":
+        self.plans[event_code] = leaf_plan(event_def, event, self.endian)
+      else:
+        self.plans[event_code] = leaf_plan(event_def, event.get('Data Values'), self.endian)
+    buf_len = len(event_data_buffer)
+    for builder, offset, elements, elementBytes, dtype in self.plans[event_code]:
+      if elements == -1:
+        #Variable number of elements, will read to end of structure
+        elements = (buf_len - offset)/elementBytes
+      try:
+        if dtype is None: #Strings
+          builder.append([event_data_buffer[offset:offset + elements*elementBytes]], trial)
+        else:
+          builder.append(pylab.frombuffer(event_data_buffer, dtype = dtype, count = elements, offset = offset), trial)
+      except ValueError:
+        logger.error('Could not decode %s at offset %d (%d elements of %d bytes)' 
+                     %(event_def['dataName'], offset, elements, elementBytes))
+
+  def columns(self):
+    """Convert the builders into LLColumns and return the data tree as plain
+    dictionaries"""
+    def convert(node):
+      if isinstance(node, ColumnBuilder):
+        return node.column(self.trial + 1)
+      return dict((key, convert(child)) for key, child in node.items())
+    return dict((key, convert(child)) for key, child in self.items())
+
+class LLColumnarReader(LLDataFileReader):
+  """Reads a lablib file into the same 'Header'/'Experiment Header'/'Trials' 
+  tree as LLDataFileReader, except that each leaf is an LLColumn. Usage is the
+  same as LLDataFileReader
+
+  R = lablib.LLColumnarReader(fname = "dj-2008-11-10-01.dat")
+  x = R.data['Trials']['eyeXData']['Data Values']
+  x.values -> every eye x sample in the file
+  x.trial_values(10) -> the eye x samples of trial 10
+  x[10] -> list of the eye x packets in trial 10
+  """
+  def new_data_dict(self, data_dict_template):
+    return ColumnSection(self.data['Header']['Events'], self.endian)
+
+  def new_trial(self, data_dict):
+    data_dict.trial += 1
+
+  def read_and_append_llevent(self, f, event_code, data_dict):
+    absolute_time, event_data_buffer = \
+      read_llevent_from_file(f, event_code, self.events_by_code, self.endian)
+    trial_time = self.set_timing_state(event_code, absolute_time, event_data_buffer)
+    data_dict.append_event(event_code, self.events_by_code[event_code], 
+                           absolute_time, trial_time, event_data_buffer)
+    return event_code
+
+  def finish(self):
+    for key in ['Experiment Header', 'Trials', 'Junk Events']:
+      self.data[key] = self.data[key].columns()
+
+class LLIndexedFile:
+  """Two pass access to a lablib file. 
+
+  The first pass (scan) walks the file and, for every event, records only the
+  event code, where its data is in the file, how long it is, its time stamp
+  and which trial it belongs to (-1 for the experiment header, -2 for events
+  between trials). Nothing is decoded. This index is saved next to the .dat
+  file (fname.idx.npz) and reused as long as the .dat file has not changed.
+
+  The second stage (decode) uses the index to read and decode any one event
+  type, for all trials or a subset of them, into the same LLColumn tree 
+  LLColumnarReader produces. So re-analysing a file with a different choice
+  of events never rescans the whole file.
+
+  I = lablib.LLIndexedFile("dj-2008-11-10-01.dat")
+  I.n_trials
+  eye_x = I.decode('eyeXData', trials = range(100))
+  eye_x['Data Values'].trial_values(0)
+
+  Note: 'Trial Time' is computed as the time from the trial's trialStart. The
+  special timing LLDataFileReader applies to the sample and spike events 
+  (which depends on reading the events in sequence) is not reproduced.
+  """
+  def __init__(self, fname, endian = '', index_fname = None, rebuild = False):
+    self.fname = fname
+    self.endian = standard_endian(endian)
+    f = open(fname, 'rb')
+    self.header, data_dict_template = readLLHeader(f, self.endian)
+    self.data_start = f.tell()
+    f.close()
+    self.events_by_code = self.header["EventsByCode"]
+    self.event_code_fmt = event_code_format(self.header)
+    self.trialStart_code = self.header["Events"]["trialStart"]["EventCode"]
+    self.trialEnd_code = self.header["Events"]["trialEnd"]["EventCode"]
+
+    if index_fname is None:
+      index_fname = fname + '.idx.npz'
+    self.index_fname = index_fname
+    st = glob.os.stat(fname)
+    self.index = None
+    if not rebuild and glob.os.path.exists(index_fname):
+      try:
+        with numpy.load(index_fname) as npz:
+          index = dict(npz.items())
+      except Exception as e: #e.g. a partly written index
+        logger.warning('Could not load index %s (%s), rebuilding it' %(index_fname, e))
+        index = {'source': [-1, -1]}
+      if index['source'][0] == st.st_size and index['source'][1] == int(st.st_mtime):
+        self.index = index
+      else:
+        logger.info('%s has changed, rebuilding index' %fname)
+    if self.index is None:
+      self.index = self.scan()
+      self.index['source'] = pylab.array([st.st_size, int(st.st_mtime)], dtype = 'i8')
+      try:
+        #We pass a file object, otherwise savez would add another .npz
+        with open(index_fname, 'wb') as fout:
+          numpy.savez(fout, **self.index)
+      except (IOError, OSError) as e:
+        logger.warning('Could not save index %s (%s). Using it from memory' %(index_fname, e))
+
+    trial = self.index['trial']
+    self.n_trials = trial.max() + 1 if trial.size else 0
+    is_start = (self.index['code'] == self.trialStart_code) & (trial >= 0)
+    self.trial_start_time = pylab.zeros(self.n_trials, dtype = 'i8')
+    self.trial_start_time[trial[is_start]] = self.index['time'][is_start]
+
+  def scan(self):
+    """First pass: index every event in the file"""
+    endian = self.endian
+    code_fmt = self.event_code_fmt
+    data_bytes = [ev["dataBytes"] for ev in self.events_by_code]
+    trialStart_code = self.trialStart_code
+    trialEnd_code = self.trialEnd_code
+
+    codes = GrowableArray('i4')
+    offsets = GrowableArray('i8')
+    nbytes = GrowableArray('i8')
+    times = GrowableArray('i8')
+    trials = GrowableArray('i4')
+
+    trial = -1
+    in_trial = False
+    f = open(self.fname, 'rb')
+    f.seek(self.data_start)
+    event_code = read_llevent_code_from_file(f, code_fmt)
+    while event_code is not None:
+      numBytes = data_bytes[event_code]
+      if numBytes < 0:
+        #Variable length data, figure it out LLDataFileReader.m:774
+        numBytes = readLLNumeric(f, endian + 'L')
+      offset = f.tell()
+      f.seek(numBytes, 1)
+      try:
+        absolute_time = readLLNumeric(f, endian + 'L')
+      except struct.error:
+        logger.error("Possible premature end of file. %d bytes read" %offset)
+        break
+
+      if not in_trial and event_code == trialStart_code:
+        trial += 1
+        in_trial = True
+      if in_trial:
+        trials.append(trial)
+      else:
+        trials.append(-1 if trial == -1 else -2)
+      if event_code == trialEnd_code:
+        in_trial = False
+
+      codes.append(event_code)
+      offsets.append(offset)
+      nbytes.append(numBytes)
+      times.append(absolute_time)
+      event_code = read_llevent_code_from_file(f, code_fmt)
+    f.close()
+
+    return {'code': codes.array(), 'offset': offsets.array(), 'nbytes': nbytes.array(), 
+            'time': times.array(), 'trial': trials.array()}
+
+  def event_counts(self, event_name):
+    """Number of events of this type in each trial"""
+    code = self.header["Events"][event_name]["EventCode"]
+    trial = self.index['trial'][(self.index['code'] == code) & (self.index['trial'] >= 0)]
+    return pylab.bincount(trial, minlength = self.n_trials)
+
+  def decode(self, event_name, trials = None, section = 'Trials'):
+    """Second stage: read and decode one event type.
+    Inputs:
+    event_name - name of the event (key of self.header["Events"])
+    trials - list of trials to decode (None for all). The result has one 
+             entry per trial in sorted order
+    section - 'Trials' or 'Experiment Header'
+    Output:
+    the data tree of this event (the equivalent of 
+    R.data['Trials'][dataName]) with LLColumns at the leaves"""
+    event_def = self.header["Events"][event_name]
+    code = event_def["EventCode"]
+    if section == 'Experiment Header':
+      trials = pylab.array([-1])
+    elif trials is None:
+      trials = pylab.arange(self.n_trials)
+    else:
+      trials = pylab.unique(trials)
+
+    idx = pylab.flatnonzero(self.index['code'] == code)
+    idx = idx[pylab.in1d(self.index['trial'][idx], trials)]
+    position = pylab.searchsorted(trials, self.index['trial'][idx])
+
+    data_dict = ColumnSection({event_name: event_def}, self.endian)
+    f = open(self.fname, 'rb')
+    for n, pos in zip(idx, position):
+      trial = self.index['trial'][n]
+      absolute_time = self.index['time'][n]
+      trial_time = absolute_time - self.trial_start_time[trial] if trial >= 0 else -1
+      f.seek(self.index['offset'][n])
+      event_data_buffer = f.read(self.index['nbytes'][n])
+      data_dict.trial = pos
+      data_dict.append_event(code, event_def, absolute_time, trial_time, event_data_buffer)
+    f.close()
+    data_dict.trial = trials.size - 1
+    return data_dict.columns()[event_def['dataName']]
+
 #Utility functions ----------------------------------------------------------
 def load_pickled(fname = 'test.pkl'):
   """Un pickle an existing file and return a LLDataFileReader structure"""
@@ -738,22 +1180,136 @@ def pickle(fname = '../Data/dj-2008-11-10-01.dat',
   
   return R
 
-def pickle_all(dir = '.', ignore_eye_data = True, force = False):
+def converted_name(fname, ignore_eye_data = True, fmt = 'pickle'):
+  """The name of the file (or session directory) fname is converted into"""
+  ext = {'pickle': '.pkl', 'session': '.session'}[fmt]
+  if ignore_eye_data:
+    return fname.replace('.dat', ext)
+  else:
+    return fname.replace('.dat', '-eye' + ext)
+
+def file_md5(fname, chunk_size = 2**20):
+  """md5 hex digest of a file, read in chunks"""
+  h = hashlib.md5()
+  f = open(fname, 'rb')
+  chunk = f.read(chunk_size)
+  while chunk:
+    h.update(chunk)
+    chunk = f.read(chunk_size)
+  f.close()
+  return h.hexdigest()
+
+def convert_one(args):
+  """Convert one file. Runs in the worker processes of convert_all.
+  Inputs:
+  args - (fname, ignore_eye_data, fmt)
+  Outputs:
+  (fname, seconds taken, error message or None, md5 of fname)"""
+  fname, ignore_eye_data, fmt = args
+  t0 = time.time()
+  try:
+    if fmt == 'session':
+      from neurapy.lablib import session
+      session.convert(fname = fname, ignore_eye_data = ignore_eye_data)
+    else:
+      pickle(fname = fname, ignore_eye_data = ignore_eye_data)
+  except Exception, e:
+    return fname, time.time() - t0, str(e), None
+  return fname, time.time() - t0, None, file_md5(fname)
+
+def convert_all(dir = '.', ignore_eye_data = True, force = False, fmt = 'pickle',
+                processes = None, manifest_fname = None):
+  """Go through a directory converting lablib data files to pickle files or 
+  sessions (see session.py), in parallel.
+
+  The size, modification time and md5 hash of every source file are kept in a
+  manifest (a json file in dir). A file is reconverted when its output is 
+  missing or when the source has changed since it was last converted. If only
+  the modification time has changed (e.g. the file was copied) we check the
+  hash before deciding.
+
+  Inputs:
+  dir - where are the files located
+  ignore_eye_data - if true don't bother to convert the eye data
+  force - if true reconvert all files
+  fmt - 'pickle' or 'session'
+  processes - number of worker processes. None uses all the cores, 1 converts
+              in this process
+  manifest_fname - where to keep the manifest. Default is 
+                   dir/lablib-<fmt>[-eye].json
+  Outputs:
+  converted - list of the files that were converted"""
+  if manifest_fname is None:
+    manifest_fname = glob.os.path.join(dir, 'lablib-' + fmt + ('' if ignore_eye_data else '-eye') + '.json')
+  manifest = {}
+  if glob.os.path.exists(manifest_fname):
+    f = open(manifest_fname, 'r')
+    manifest = json.load(f)
+    f.close()
+
+  to_convert = []
+  for dat_file in sorted(glob.glob(dir + '/*.dat')):
+    key = glob.os.path.basename(dat_file)
+    st = glob.os.stat(dat_file)
+    entry = manifest.get(key)
+    out_file = converted_name(dat_file, ignore_eye_data, fmt)
+    if force or not glob.os.path.exists(out_file):
+      to_convert.append(dat_file)
+    elif entry is None:
+      #Converted before we kept a manifest. Trust it if it is newer than the source
+      if glob.os.path.getmtime(out_file) < st.st_mtime:
+        to_convert.append(dat_file)
+      else:
+        manifest[key] = {'size': st.st_size, 'mtime': st.st_mtime, 'md5': file_md5(dat_file)}
+    elif entry['size'] != st.st_size:
+      to_convert.append(dat_file)
+    elif entry['mtime'] != st.st_mtime:
+      if entry['md5'] != file_md5(dat_file):
+        to_convert.append(dat_file)
+      else:
+        entry['mtime'] = st.st_mtime
+  logger.info('%d files to convert, %d up to date' %(len(to_convert), len(glob.glob(dir + '/*.dat')) - len(to_convert)))
+
+  jobs = [(dat_file, ignore_eye_data, fmt) for dat_file in to_convert]
+  t0 = time.time()
+  if processes == 1 or len(jobs) < 2:
+    results = [convert_one(job) for job in jobs]
+  else:
+    pool = multiprocessing.Pool(processes = processes)
+    results = pool.map(convert_one, jobs)
+    pool.close()
+    pool.join()
+  wall_time = time.time() - t0
+
+  converted = []
+  total_bytes = 0
+  for dat_file, seconds, error, md5 in results:
+    st = glob.os.stat(dat_file)
+    if error is not None:
+      logger.error('%s: conversion failed (%s)' %(dat_file, error))
+      manifest.pop(glob.os.path.basename(dat_file), None)
+      continue
+    logger.info('%s: %.1f MB in %.1f s (%.1f MB/s)' 
+                %(dat_file, st.st_size/1e6, seconds, st.st_size/1e6/max(seconds, 1e-6)))
+    manifest[glob.os.path.basename(dat_file)] = \
+      {'size': st.st_size, 'mtime': st.st_mtime, 'md5': md5, 'seconds': seconds}
+    converted.append(dat_file)
+    total_bytes += st.st_size
+  if converted:
+    logger.info('Converted %d files, %.1f MB in %.1f s (%.1f MB/s)' 
+                %(len(converted), total_bytes/1e6, wall_time, total_bytes/1e6/max(wall_time, 1e-6)))
+
+  f = open(manifest_fname, 'w')
+  json.dump(manifest, f, indent = 1, sort_keys = True)
+  f.close()
+  return converted
+
+def pickle_all(dir = '.', ignore_eye_data = True, force = False, processes = None):
   """Go through a directory converting lablib data files to pickle files.
   Inputs:
   dir - where are the files located
   ignore_eye_data - if true don't bother to pickle the eye data
-  force - if true reconvert files even if they have an existing pickle file"""
-  
-  dat_files = glob.glob(dir + '/*.dat')
-  for n in xrange(len(dat_files)):
-    if ignore_eye_data:
-      pkl_file = dat_files[n].replace('.dat','.pkl')
-    else:
-      pkl_file = dat_files[n].replace('.dat','-eye.pkl')
-    
-    if glob.os.path.exists(pkl_file) and not force:
-        continue
-      
-    pickle(fname = dat_files[n], ignore_eye_data = ignore_eye_data)  
-    
\ No newline at end of file
+  force - if true reconvert files even if they have an up to date pickle file
+  processes - number of worker processes (see convert_all)"""
+  return convert_all(dir = dir, ignore_eye_data = ignore_eye_data, force = force, 
+                     fmt = 'pickle', processes = processes)
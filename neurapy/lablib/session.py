@@ -0,0 +1,165 @@
+"""Session files: a fast, memory mappable replacement for the pickled lablib
+data.
+
+A session is a directory holding one .npy file for each array of each LLColumn
+(see lablib.LLColumnarReader) together with a small manifest.json that records
+the file header and the layout of the data tree. Opening a session only reads
+the manifest. A field is loaded the first time it is asked for and numeric
+fields are memory mapped, so the eye data costs no memory (and no time) until
+it is actually touched.
+
+Example usage:
+
+from neurapy.lablib import session
+
+R = session.convert("dj-2008-11-10-01.dat", ignore_eye_data = False)
+ -> writes dj-2008-11-10-01-eye.session/
+
+R = session.load_session("dj-2008-11-10-01-eye.session")
+R.data['Trials']['eyeXData']['Data Values'].trial_values(10)
+
+R.data behaves like the data of LLColumnarReader ('Header',
+'Experiment Header', 'Trials', 'Junk Events').
+"""
+import json, logging, os, re, numpy
+from neurapy.lablib.lablib import LLColumn, LLColumnarReader, LLDataFileReader
+
+logger = logging.getLogger(__name__)
+
+manifest_name = 'manifest.json'
+session_version = 1
+sections = ['Experiment Header', 'Trials', 'Junk Events']
+
+def column_arrays(C):
+  """The arrays of LLColumn C, by name"""
+  arrays = {'values': C.values, 'trial_offsets': C.trial_offsets}
+  if not C.scalar:
+    arrays['event_offsets'] = C.event_offsets
+  return arrays
+
+def array_fname(path, name):
+  """A file name for the array 'name' of the column at path (a list of keys)"""
+  return re.sub('[^\w.-]', '_', '.'.join(path + [name])) + '.npy'
+
+def save_tree(node, path, dirname):
+  """Save every LLColumn under node and return the matching layout tree (a
+  dictionary with a column description at each leaf)."""
+  if isinstance(node, LLColumn):
+    files = {}
+    for name, arr in column_arrays(node).items():
+      files[name] = array_fname(path, name)
+      numpy.save(os.path.join(dirname, files[name]), arr)
+    return {'column': True, 'scalar': node.scalar, 'files': files,
+            'dtype': str(node.values.dtype), 'n_values': int(node.values.size)}
+  return dict((key, save_tree(child, path + [key], dirname)) for key, child in node.items())
+
+def save_session(data, dirname, source = None):
+  """Save the data tree of a LLColumnarReader as a session directory.
+  Inputs:
+  data - R.data from LLColumnarReader
+  dirname - the session directory. Created if needed, existing files are
+            overwritten
+  source - optional name of the .dat file, recorded in the manifest"""
+  if not os.path.exists(dirname):
+    os.makedirs(dirname)
+  header = dict((k, v) for k, v in data['Header'].items() if k != 'EventsByCode')
+  manifest = {'version': session_version,
+              'source': source,
+              'Header': header,
+              'N Event Types': len(data['Header']['EventsByCode'])}
+  for key in sections:
+    manifest[key] = save_tree(data[key], [key], dirname)
+  f = open(os.path.join(dirname, manifest_name), 'w')
+  json.dump(manifest, f, indent = 1)
+  f.close()
+
+def load_column(dirname, desc, mmap_mode = 'r'):
+  """Load the LLColumn described by desc. Object arrays (strings) can not be
+  memory mapped and are loaded into memory."""
+  arrays = {}
+  for name, fname in desc['files'].items():
+    if desc['dtype'] == 'object' and name == 'values':
+      arrays[name] = numpy.load(os.path.join(dirname, fname), allow_pickle = True)
+    else:
+      arrays[name] = numpy.load(os.path.join(dirname, fname), mmap_mode = mmap_mode)
+  return LLColumn(arrays['values'], arrays.get('event_offsets'),
+                  arrays['trial_offsets'], desc['scalar'])
+
+class SessionNode(dict):
+  """One level of the data tree of a session. Columns are loaded the first time
+  they are accessed and kept from then on."""
+  def __init__(self, dirname, layout, mmap_mode = 'r'):
+    dict.__init__(self)
+    self.dirname = dirname
+    self.mmap_mode = mmap_mode
+    for key, desc in layout.items():
+      if desc.get('column') is True:
+        dict.__setitem__(self, key, desc)
+      else:
+        dict.__setitem__(self, key, SessionNode(dirname, desc, mmap_mode))
+
+  def __getitem__(self, key):
+    value = dict.__getitem__(self, key)
+    if not isinstance(value, (SessionNode, LLColumn)):
+      value = load_column(self.dirname, value, self.mmap_mode)
+      dict.__setitem__(self, key, value)
+    return value
+
+  def get(self, key, default = None):
+    if key in self:
+      return self[key]
+    return default
+
+  def values(self):
+    return [self[key] for key in self.keys()]
+
+  def items(self):
+    return [(key, self[key]) for key in self.keys()]
+
+def load_session(dirname, mmap_mode = 'r'):
+  """Open a session directory and return a LLDataFileReader structure. Only
+  the manifest is read here.
+  Inputs:
+  dirname - the session directory
+  mmap_mode - passed on to numpy.load. Use None to read fields into memory
+              rather than memory mapping them"""
+  f = open(os.path.join(dirname, manifest_name), 'r')
+  manifest = json.load(f)
+  f.close()
+  if manifest.get('version') != session_version:
+    logger.warning('%s: session version %s, expected %d' %(dirname, manifest.get('version'), session_version))
+
+  header = manifest['Header']
+  header['EventsByCode'] = [None]*manifest['N Event Types']
+  for event_def in header['Events'].values():
+    header['EventsByCode'][event_def['EventCode']] = event_def
+
+  R = LLDataFileReader()
+  R.data = {'Header': header}
+  for key in sections:
+    R.data[key] = SessionNode(dirname, manifest[key], mmap_mode)
+  return R
+
+def session_name(fname, ignore_eye_data = True):
+  """The session directory we convert fname (a .dat file) into"""
+  if ignore_eye_data:
+    return fname.replace('.dat','.session')
+  else:
+    return fname.replace('.dat','-eye.session')
+
+def convert(fname = '../Data/dj-2008-11-10-01.dat', ignore_eye_data = True):
+  """Like lablib.pickle, but saves a session rather than a pickle file.
+  Inputs:
+  fname - filename of lablib .dat file
+  ignore_eye_data - true or false depending on if we wanna load the eye positon
+                    and pupil data
+  Outputs:
+  R - the data structure. The session is saved automatically, substituting the
+      extension .dat with .session (-eye.session if the eye data is kept)"""
+  if ignore_eye_data:
+    ignore_events = ['eyeXData','eyeYData','eyePData']
+  else:
+    ignore_events = None
+  R = LLColumnarReader(fname = fname, ignore_events = ignore_events)
+  save_session(R.data, session_name(fname, ignore_eye_data), source = os.path.basename(fname))
+  return R
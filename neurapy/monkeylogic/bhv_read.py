@@ -7,6 +7,7 @@ Kaushik Ghose (kaushik.ghose@gmail.com)
 """
 from struct import unpack as upk, calcsize as csize
 import pylab, logging
+from neurapy.utility.ragged import RaggedArray
 logger = logging.getLogger(__name__)
 
 def unpack(fmt,f):
@@ -21,11 +22,21 @@ def unpack(fmt,f):
   ans = upk(fmt, f.read(csize(fmt)))
   return tuple(an.strip() if isinstance(an, str) else an for an in ans)
 
-def read_header(bhv, fin):
+def read_pixels(fin, sz):
+  """Read one picture or movie frame of size sz (as stored in the header) in a
+  single call. The file stores the color planes one after the other, each plane
+  row by row, so the data is reshaped to (planes, rows, cols) and transposed to
+  give the (cols, rows, planes) array the header describes."""
+  return pylab.fromfile(fin, dtype=pylab.uint8, count=sz[0]*sz[1]*sz[2]).reshape(sz[2], sz[1], sz[0]).T
+
+def read_header(bhv, fin, load_stimuli=True):
   """Reads the header of a .bhv file. Call this first.
   Inputs:
     bhv - a dictionary (can be empty)
     fin - file handle
+    load_stimuli - if False, the picture and movie data is skipped. 'Data' is
+                   set to None and 'Offset' records where the data is in the
+                   file, so it can be loaded later with load_stimulus
   Returns:
     True if no errors
     False otherwise
@@ -135,7 +146,12 @@ def read_header(bhv, fin):
     pic[n]['Size'] = unpack('3H', fin)
   for n in xrange(np):
     sz = pic[n]['Size']
-    pic[n]['Data'] = pylab.array([[unpack(sz[0]*'B', fin) for j in xrange(sz[1])] for k in xrange(sz[2])]).T
+    pic[n]['Offset'] = fin.tell()
+    if load_stimuli:
+      pic[n]['Data'] = read_pixels(fin, sz)
+    else:
+      pic[n]['Data'] = None
+      fin.seek(sz[0]*sz[1]*sz[2], 1)
   bhv['Stimuli'] = {
     'NumPics': np,
     'Pic': pic
@@ -147,20 +163,276 @@ def read_header(bhv, fin):
     for n in xrange(nm):
       mov[n]['Name'], = unpack('128s', fin)
     for n in xrange(nm):
-      mov[n]['Size'], = unpack('3H', fin)
+      mov[n]['Size'] = unpack('3H', fin)
       mov[n]['NumFrames'], = unpack('H', fin)
     for n in xrange(nm):
       sz = mov[n]['Size']
       numframes = mov[n]['NumFrames']
-      mov[n]['Data'] = []
-      for fr in xrange(numframes):
-        mov[n]['Data'].append(pylab.array([[unpack(sz[0]*'B', fin) for j in xrange(sz[1])] for k in xrange(sz[2])]).T)
+      mov[n]['Offset'] = fin.tell()
+      if load_stimuli:
+        mov[n]['Data'] = [read_pixels(fin, sz) for fr in xrange(numframes)]
+      else:
+        mov[n]['Data'] = None
+        fin.seek(sz[0]*sz[1]*sz[2]*numframes, 1)
     bhv['Stimuli']['NumMovs'] = nm
     bhv['Stimuli']['Mov'] = mov
 
   logger.info('Read header (' + str(fin.tell()) + ' bytes)')
   return True
 
+# Trials ----------------------------------------------------------------------
+# Each trial is a block of scalars followed by these sections, in this order.
+# Each section has a reader, which decodes it, and a skipper, which moves the
+# file past it (returning any scalars we want to keep) so we can index a file
+# quickly.
+sections = ['codes', 'analog', 'object status', 'rewards', 'user vars']
+
+def read_trial_scalars(fin, fv):
+  """Read the scalars at the start of a trial"""
+  t = {'AbsoluteTrialStartTime': None, 'CycleRate': 0, 'MinCycleRate': 0}
+  t['TrialNumber'], = unpack('H', fin)
+  if fv > 2.2:
+    numc, = unpack('B', fin)
+    t['AbsoluteTrialStartTime'] = unpack('d'*numc, fin)
+
+  t['BlockNumber'], t['ConditionNumber'], t['TrialError'] = unpack('3H', fin)
+  if fv >=2.05:
+    t['CycleRate'], = unpack('H', fin)
+    if fv >= 2.72:
+      t['MinCycleRate'] = unpack('H', fin)[0] if t['CycleRate']>0 else 0
+  return t
+
+def read_codes(fin, fv):
+  ncodes, = unpack('H', fin)
+  coden = unpack('H'*ncodes, fin)
+  if fv>=3.0:
+    codet = unpack('I'*ncodes, fin)
+  else:
+    codet = unpack('H'*ncodes, fin)
+  return {'NumCodes': ncodes, 'CodeNumbers': coden, 'CodeTimes': codet}
+
+def skip_codes(fin, fv):
+  ncodes, = unpack('H', fin)
+  fin.seek(ncodes*(2 + (4 if fv>=3.0 else 2)), 1)
+  return {'NumCodes': ncodes}
+
+def analog_channels(fv):
+  """The analog channels in a trial, in file order, as (key, index, format).
+  index is None except for OtherAnalogData, which is a list of 9 channels"""
+  if fv <= 1.5:
+    return []
+  if fv > 1.6:
+    fmt='f'
+  else:
+    fmt='d'
+  channels = [('XEye', None, fmt), ('YEye', None, fmt), ('XJoy', None, fmt), ('YJoy', None, fmt)]
+  if fv > 2.5:
+    channels += [('OtherAnalogData', n, 'f') for n in xrange(9)]
+  if fv >= 1.8:
+    channels += [('PhotoDiode', None, 'f')]
+  return channels
+
+def read_analog(fin, fv):
+  a = {'XEye': None, 'YEye': None, 'XJoy': None, 'YJoy': None, 'OtherAnalogData': [None]*9, 'PhotoDiode': None,
+       'ReactionTime': 0}
+  channels = analog_channels(fv)
+  for key, n, fmt in channels:
+    npts, = unpack('I', fin)
+    data = pylab.fromfile(fin, dtype=fmt, count=npts).astype(pylab.float32)
+    if n is None:
+      a[key] = data
+    else:
+      a[key][n] = data
+  if channels:
+    a['ReactionTime'], = unpack('h', fin)
+  return a
+
+def skip_analog(fin, fv):
+  """Also returns, as 'AnalogIndex', the file offset and number of points of
+  each channel (channels x 2 array), for read_analog_channels"""
+  channels = analog_channels(fv)
+  where = pylab.zeros((len(channels), 2), dtype=pylab.int64)
+  for c, (key, n, fmt) in enumerate(channels):
+    npts, = unpack('I', fin)
+    where[c] = fin.tell(), npts
+    fin.seek(npts*csize(fmt), 1)
+  if channels:
+    return {'ReactionTime': unpack('h', fin)[0], 'AnalogIndex': where}
+  return {'ReactionTime': 0, 'AnalogIndex': where}
+
+def read_analog_channels(fin, fv, analog_index):
+  """Read the analog channels of a set of trials. Each channel goes into one
+  preallocated float32 buffer, which the data is read straight into, trial by
+  trial.
+  Inputs:
+    fin - file handle
+    fv - file version
+    analog_index - trials x channels x 2 array of file offset and number of
+                   points (see skip_analog)
+  Returns:
+    dictionary with a RaggedArray (element tr is trial tr) for each of XEye,
+    YEye, XJoy, YJoy, PhotoDiode and a list of 9 RaggedArrays for
+    OtherAnalogData. Channels not in this file version are None
+  """
+  a = {'XEye': None, 'YEye': None, 'XJoy': None, 'YJoy': None, 'OtherAnalogData': [None]*9, 'PhotoDiode': None}
+  channels = analog_channels(fv)
+  n_trials = analog_index.shape[0]
+  offsets = [None]*len(channels)
+  buffers = [None]*len(channels)
+  for c in xrange(len(channels)):
+    offsets[c] = pylab.concatenate(([0], pylab.cumsum(analog_index[:, c, 1]))).astype(pylab.int64)
+    buffers[c] = pylab.empty(offsets[c][-1], dtype=pylab.float32)
+  for trl in xrange(n_trials):
+    for c, (key, n, fmt) in enumerate(channels):
+      pos, npts = analog_index[trl, c]
+      if npts == 0:
+        continue
+      fin.seek(pos)
+      dest = buffers[c][offsets[c][trl]:offsets[c][trl+1]]
+      if fmt == 'f':
+        fin.readinto(dest)
+      else:
+        dest[:] = pylab.fromfile(fin, dtype=fmt, count=npts)
+  for c, (key, n, fmt) in enumerate(channels):
+    if n is None:
+      a[key] = RaggedArray(buffers[c], offsets[c])
+    else:
+      a[key][n] = RaggedArray(buffers[c], offsets[c])
+  return a
+
+def read_object_status(fin, fv):
+  osr_status_trl = []
+  osr_time_trl = []
+  osr_data_trl = []
+  if fv >= 1.9:
+    numstat, = unpack('I', fin)
+    osr_status_trl = [None]*numstat
+    osr_time_trl = [0]*numstat
+    osr_data_trl = [None]*numstat
+    if fv >= 2.00:
+      for n in xrange(numstat):
+        nb, = unpack('I', fin)
+        osr_status_trl[n] = unpack('B'*nb, fin)
+        osr_time_trl[n], = unpack('I', fin)
+        if any(x>1 for x in osr_status_trl[n]):
+          nf, = unpack('B', fin)
+          osr_data_trl[n] = [None]*nf
+          for fnum in xrange(nf):
+            dc, = unpack('I', fin)
+            osr_data_trl[n][fnum] = unpack('d'*dc, fin)
+    else:
+      for n in xrange(numstat):
+        nb, = unpack('I', fin)
+        osr_status_trl[n] = unpack('B'*nb, fin)#This might need to be masked in some way
+        osr_time_trl[n], = unpack('I', fin)
+  return {'Status': osr_status_trl, 'Time': osr_time_trl, 'Data': osr_data_trl}
+
+def skip_object_status(fin, fv):
+  if fv >= 1.9:
+    numstat, = unpack('I', fin)
+    for n in xrange(numstat):
+      nb, = unpack('I', fin)
+      status = fin.read(nb)
+      fin.seek(4, 1)
+      if fv >= 2.00 and any(ord(x)>1 for x in status):
+        nf, = unpack('B', fin)
+        for fnum in xrange(nf):
+          dc, = unpack('I', fin)
+          fin.seek(8*dc, 1)
+  return {}
+
+def read_rewards(fin, fv):
+  ront = rofft = None
+  if fv >= 1.95:
+    nrew, = unpack('I', fin)
+    ront = unpack('I'*nrew, fin)
+    rofft = unpack('I'*nrew, fin)
+  return {'RewardOnTime': ront, 'RewardOffTime': rofft}
+
+def skip_rewards(fin, fv):
+  if fv >= 1.95:
+    nrew, = unpack('I', fin)
+    fin.seek(8*nrew, 1)
+  return {}
+
+def read_user_vars(fin, fv):
+  """User variables as a list of [name, value] pairs"""
+  usrvars = None
+  if fv >= 2.7:
+    nuv, = unpack('B', fin)
+    usrvars = [None]*nuv
+    for n in xrange(nuv):
+      varv = None
+      varn, type = unpack('32sc', fin)
+      if type == 'd':
+        lenv, = unpack('B', fin)
+        varv = unpack('d'*lenv, fin)
+      elif type == 'c':
+        varv, = unpack('128s', fin)
+      usrvars[n] = [varn, varv]
+  return {'UserVars': usrvars}
+
+def skip_user_vars(fin, fv):
+  if fv >= 2.7:
+    nuv, = unpack('B', fin)
+    for n in xrange(nuv):
+      varn, type = unpack('32sc', fin)
+      if type == 'd':
+        lenv, = unpack('B', fin)
+        fin.seek(8*lenv, 1)
+      elif type == 'c':
+        fin.seek(128, 1)
+  return {}
+
+section_readers = [read_codes, read_analog, read_object_status, read_rewards, read_user_vars]
+section_skippers = [skip_codes, skip_analog, skip_object_status, skip_rewards, skip_user_vars]
+
+def index_trials(fin, fv, n_trials, keys=None):
+  """One fast pass over the trials that reads the per trial scalars and skips
+  the contents of the sections.
+  Inputs:
+    fin - file handle positioned at the first trial
+    fv - file version
+    n_trials - number of trials
+    keys - if not None, decode the sections (all but the analog data) in the
+           same pass and return these of their keys
+  Returns dictionary with
+    'scalars' - dictionary of lists (TrialNumber, AbsoluteTrialStartTime,
+                BlockNumber, ConditionNumber, TrialError, CycleRate,
+                MinCycleRate, NumCodes, ReactionTime)
+    'trial offsets' - file offset of each trial
+    'offsets' - trials x sections array with the file offset of each section
+    'analog' - trials x channels x 2 array of file offset and number of
+               points of each analog channel
+    'trials' - (if keys is given) dictionary of lists, one entry per trial
+  fin is left at the end of the trials
+  """
+  scalar_keys = ['TrialNumber', 'AbsoluteTrialStartTime', 'BlockNumber', 'ConditionNumber', 'TrialError',
+                 'CycleRate', 'MinCycleRate', 'NumCodes', 'ReactionTime']
+  scalars = dict((key, [None]*n_trials) for key in scalar_keys)
+  trial_offsets = pylab.zeros(n_trials, dtype=pylab.int64)
+  offsets = pylab.zeros((n_trials, len(sections)), dtype=pylab.int64)
+  analog = pylab.zeros((n_trials, len(analog_channels(fv)), 2), dtype=pylab.int64)
+  trials = dict((key, [None]*n_trials) for key in keys or [])
+  for trl in xrange(n_trials):
+    trial_offsets[trl] = fin.tell()
+    t = read_trial_scalars(fin, fv)
+    for n, skipper in enumerate(section_skippers):
+      offsets[trl, n] = fin.tell()
+      if keys is not None and sections[n] != 'analog':
+        t.update(section_readers[n](fin, fv))
+      else:
+        t.update(skipper(fin, fv))
+    for key in scalar_keys:
+      scalars[key][trl] = t[key]
+    for key in trials:
+      trials[key][trl] = t[key]
+    analog[trl] = t['AnalogIndex']
+  index = {'scalars': scalars, 'trial offsets': trial_offsets, 'offsets': offsets, 'analog': analog}
+  if keys is not None:
+    index['trials'] = trials
+  return index
+
 def read_trials(bhv, fin):
   """Reads the meat of the .bhv file: the trials. Call this after reading the
   header.
@@ -178,150 +450,27 @@ def read_trials(bhv, fin):
   bhv['NumTrials'], = unpack('H', fin)
   nTrials = bhv['NumTrials']
   logger.info('File contains ' + str(nTrials) + ' trials')
-  tno = [0]*nTrials
-  atst = [None]*nTrials
-  bn = [0]*nTrials
-  bi = [0]*nTrials
-  cn = [0]*nTrials
-  te = [0]*nTrials
-  cr = [0]*nTrials
-  mcr = [0]*nTrials
-  ncodes = [0]*nTrials
-  coden = [0]*nTrials
-  codet = [0]*nTrials
-  xeye = [None]*nTrials
-  yeye = [None]*nTrials
-  xjoy = [None]*nTrials
-  yjoy = [None]*nTrials
-  other_analog_data = [[None]*9]*nTrials
-
-  photodiode = [None]*nTrials
-  rt = [0]*nTrials
-  osr_status = [None]*nTrials
-  osr_time = [0]*nTrials
-  osr_data = [None]*nTrials
-  rr_ront = [None]*nTrials
-  rr_rofft = [None]*nTrials
-  usrvars = [None]*nTrials
-
-  for trl in xrange(nTrials):
-    tno[trl], = unpack('H', fin)
-    if fv > 2.2:
-      numc, = unpack('B', fin)
-      atst[trl] = unpack('d'*numc, fin)
-
-    bn[trl], cn[trl], te[trl] = unpack('3H', fin)
-    if fv >=2.05:
-      cr[trl], = unpack('H', fin)
-      if fv >= 2.72:
-        mcr[trl] = unpack('H', fin)[0] if cr[trl]>0 else 0
-
-    ncodes[trl], = unpack('H', fin)
-    coden[trl] = unpack('H'*ncodes[trl], fin)
-    if fv>=3.0:
-      codet[trl] = unpack('I'*ncodes[trl], fin)
-    else:
-      codet[trl] = unpack('H'*ncodes[trl], fin)
-
-    if fv > 1.5:
-      if fv > 1.6:
-        fmt='f'
-      else:
-        fmt='d'
-
-      nxeyep, = unpack('I', fin)
-      xeye[trl] = pylab.array(unpack(fmt*nxeyep, fin), dtype=pylab.float16)
-      nyeyep, = unpack('I', fin)
-      yeye[trl] = pylab.array(unpack(fmt*nyeyep, fin), dtype=pylab.float16)
-
-      nxjoyp, = unpack('I', fin)
-      xjoy[trl] = pylab.array(unpack(fmt*nxjoyp, fin), dtype=pylab.float16)
-      nyjoyp, = unpack('I', fin)
-      yjoy[trl] = pylab.array(unpack(fmt*nyjoyp, fin), dtype=pylab.float16)
-
-      if fv > 2.5:
-        for n in xrange(9):
-          npts, = unpack('I', fin)
-          other_analog_data[trl][n] = pylab.array(unpack('f'*npts, fin), dtype=pylab.float16)
-      if fv >= 1.8:
-        npts, = unpack('I', fin)
-        photodiode[trl] = pylab.array(unpack('f'*npts, fin), dtype=pylab.float16)
-
-      rt[trl], = unpack('h', fin)
-
-    if fv >= 1.9:
-      numstat, = unpack('I', fin)
-      osr_status_trl = [None]*numstat
-      osr_time_trl = [0]*numstat
-      osr_data_trl = [None]*numstat
-      if fv >= 2.00:
-        for n in xrange(numstat):
-          nb, = unpack('I', fin)
-          osr_status_trl[n] = unpack('B'*nb, fin)
-          osr_time_trl[n], = unpack('I', fin)
-          if any(x>1 for x in osr_status_trl[n]):
-            nf, = unpack('B', fin)
-            osr_data_trl[n] = [None]*nf
-            for fnum in xrange(nf):
-              dc, = unpack('I', fin)
-              osr_data_trl[n][fnum] = unpack('d'*dc, fin)
-      else:
-        for n in xrange(numstat):
-          nb, = unpack('I', fin)
-          osr_status_trl[n] = unpack('B'*nb, fin)#This might need to be masked in some way
-          osr_time_trl[n], = unpack('I', fin)
-
-      osr_status[trl] = osr_status_trl
-      osr_time[trl] = osr_time_trl
-      osr_data[trl] = osr_data_trl
-
-    if fv >= 1.95:
-      nrew, = unpack('I', fin)
-      rr_ront[trl] = unpack('I'*nrew, fin)
-      rr_rofft[trl] = unpack('I'*nrew, fin)
-
-    if fv >= 2.7:
-      nuv, = unpack('B', fin)
-      usrvars[trl] = ['',[None]*nuv]
-      for n in xrange(nuv):
-        varv = None
-        varn, type = unpack('32sc', fin)
-        if type == 'd':
-          lenv, = unpack('B', fin)
-          varv = unpack('d'*lenv, fin)
-        elif type == 'c':
-          varv = unpack('128s', fin)
-        usrvars[trl][n][0] = varn
-        usrvars[trl][n][1] = varv
-
-  bhv['TrialNumber'] = tno
-  bhv['AbsoluteTrialStartTime'] = atst
-  bhv['BlockNumber'] = bn
-  bhv['BlockIndex'] = bi
-  bhv['ConditionNumber'] = cn
-  bhv['TrialError'] = te
-  bhv['CycleRate'] = cr
-  bhv['MinCycleRate'] = mcr
-  bhv['NumCodes'] = ncodes
-  bhv['CodeNumbers'] = coden
-  bhv['CodeTimes'] = codet
-  bhv['XEye'] = xeye
-  bhv['YEye'] = yeye
-  bhv['XJoy'] = xjoy
-  bhv['YJoy'] = yjoy
-  bhv['OtherAnalogData'] = other_analog_data
-  bhv['PhotoDiode'] = photodiode
-  bhv['ReactionTime'] = rt
+  keys = ['NumCodes', 'CodeNumbers', 'CodeTimes', 'Status', 'Time', 'Data', 'RewardOnTime', 'RewardOffTime',
+          'UserVars']
+  index = index_trials(fin, fv, nTrials, keys)
+  end_of_trials = fin.tell()
+
+  for key in keys:
+    bhv[key] = index['trials'][key]
+  for key in index['scalars']:
+    bhv[key] = index['scalars'][key]
+  bhv.update(read_analog_channels(fin, fv, index['analog']))
+  fin.seek(end_of_trials)
+  bhv['BlockIndex'] = [0]*nTrials
   bhv['ObjectStatusRecord'] = {
-    'Status': osr_status,
-    'Time': osr_time,
-    'Data': osr_data
+    'Status': bhv.pop('Status'),
+    'Time': bhv.pop('Time'),
+    'Data': bhv.pop('Data')
   }
   bhv['RewardRecord'] = {
-    'RewardOnTime': rr_ront,
-    'RewardOffTime': rr_rofft
+    'RewardOnTime': bhv.pop('RewardOnTime'),
+    'RewardOffTime': bhv.pop('RewardOffTime')
   }
-  bhv['UserVars'] = usrvars
 
   logger.info('Finished reading trials (' + str(fin.tell()) + ' bytes)')
   return True
@@ -362,18 +511,147 @@ def read_footer(bhv, fin):
 
 
 
-def read_bhv(fname = '../SampleData/WMHU-MJT-06-04-2012.bhv'):
+def load_stimulus(fname, stim):
+  """Load the image data of a picture or movie that was skipped when the header
+  was read with load_stimuli=False.
+  Inputs:
+    fname - name of the .bhv file
+    stim - an entry of bhv['Stimuli']['Pic'] or bhv['Stimuli']['Mov']
+  Output:
+    the picture array, or list of frame arrays for a movie. This is also stored
+    in stim['Data']
+  """
+  with open(fname, "rb") as fin:
+    fin.seek(stim['Offset'])
+    if 'NumFrames' in stim:
+      stim['Data'] = [read_pixels(fin, stim['Size']) for fr in xrange(stim['NumFrames'])]
+    else:
+      stim['Data'] = read_pixels(fin, stim['Size'])
+  return stim['Data']
+
+def read_bhv(fname = '../SampleData/WMHU-MJT-06-04-2012.bhv', load_stimuli=True):
   """Reads a behavioral file. TODO: partial recovery of files.
   Input:
     fname - name of the file
+    load_stimuli - if False skip the stimulus image data (see read_header)
   Output:
     bhv - dictionary with the behavioral data
   """
   logger.info('Opening ' + fname)
   with open(fname, "rb") as fin:
     bhv = {}
-    if read_header(bhv, fin):
+    if read_header(bhv, fin, load_stimuli=load_stimuli):
       read_trials(bhv, fin)
       read_footer(bhv, fin)
 
-  return bhv
\ No newline at end of file
+  return bhv
+
+class BhvFile:
+  """Indexed, lazy access to a .bhv file.
+
+  Opening the file reads the header (without the stimulus images, by default),
+  then makes one fast pass over the trials. The pass reads the per trial
+  scalars (trial number, block, condition, error, cycle rates, number of codes,
+  reaction time) and records where each section of each trial (codes, analog
+  data, object status record, rewards, user variables) starts in the file, but
+  skips over the contents. Any other field is decoded on demand, for just the
+  trials asked for.
+
+  with bhv_read.BhvFile('my_bhv_file.bhv') as bf:
+    bf.field('ConditionNumber') -> array, from the index
+    bf.field('TrialError')
+    bf.field('XEye', trials=[0, 10, 20]) -> RaggedArray, one element per trial
+    bf.field('ObjectStatusRecord', trials=range(5)) -> dictionary of lists
+
+  bf.header has the header and footer entries of read_bhv
+  """
+  scalar_fields = ['TrialNumber', 'BlockNumber', 'ConditionNumber', 'TrialError', 'CycleRate', 'MinCycleRate',
+                   'NumCodes', 'ReactionTime']
+  #Fields decoded on demand: name -> (section, key in the section reader's output)
+  section_fields = {
+    'CodeNumbers': ('codes', 'CodeNumbers'),
+    'CodeTimes': ('codes', 'CodeTimes'),
+    'XEye': ('analog', 'XEye'),
+    'YEye': ('analog', 'YEye'),
+    'XJoy': ('analog', 'XJoy'),
+    'YJoy': ('analog', 'YJoy'),
+    'OtherAnalogData': ('analog', 'OtherAnalogData'),
+    'PhotoDiode': ('analog', 'PhotoDiode'),
+    'ObjectStatusRecord': ('object status', None),
+    'RewardRecord': ('rewards', None),
+    'UserVars': ('user vars', 'UserVars')
+  }
+
+  def __init__(self, fname, load_stimuli=False):
+    self.fname = fname
+    self.fin = open(fname, 'rb')
+    self.header = {}
+    if not read_header(self.header, self.fin, load_stimuli=load_stimuli):
+      self.fin.close()
+      raise IOError('Could not read header of ' + fname)
+    self.fv = self.header['FileVersion']
+    self.scan()
+    read_footer(self.header, self.fin)
+
+  def scan(self):
+    """Index the trials. Fills self.offsets (trials x sections) and the scalar
+    fields"""
+    fin, fv = self.fin, self.fv
+    fin.seek(1024, 1) #Padding
+    n_trials, = unpack('H', fin)
+    self.n_trials = n_trials
+    index = index_trials(fin, fv, n_trials)
+    self.trial_offsets = index['trial offsets']
+    self.offsets = index['offsets']
+    self.analog_index = index['analog']
+    self.absolute_trial_start_time = index['scalars']['AbsoluteTrialStartTime']
+    self.scalars = dict((key, pylab.array(index['scalars'][key])) for key in self.scalar_fields)
+    logger.info('Indexed {:d} trials ({:d} bytes)'.format(n_trials, fin.tell()))
+
+  def __len__(self):
+    return self.n_trials
+
+  def fields(self):
+    return self.scalar_fields + ['AbsoluteTrialStartTime'] + sorted(self.section_fields.keys())
+
+  def read_section(self, trl, section):
+    """Decode one section of one trial"""
+    n = sections.index(section)
+    self.fin.seek(self.offsets[trl, n])
+    return section_readers[n](self.fin, self.fv)
+
+  def field(self, name, trials=None):
+    """Return a field for a set of trials.
+    Inputs:
+      name - a key of the bhv dictionary read_bhv returns, e.g. 'ConditionNumber', 'CodeTimes', 'XEye'
+      trials - list of trial indexes (from 0). None for all trials
+    Outputs:
+      an array for the scalar fields, a RaggedArray for the analog channels
+      (a list of 9 for OtherAnalogData), a dictionary of lists for
+      ObjectStatusRecord and RewardRecord, a list otherwise
+    """
+    if trials is None:
+      trials = xrange(self.n_trials)
+    if name in self.scalars:
+      return self.scalars[name][list(trials)]
+    if name == 'AbsoluteTrialStartTime':
+      return [self.absolute_trial_start_time[trl] for trl in trials]
+    if name not in self.section_fields:
+      raise KeyError(name)
+    section, key = self.section_fields[name]
+    if section == 'analog':
+      return read_analog_channels(self.fin, self.fv, self.analog_index[list(trials)])[name]
+    values = [self.read_section(trl, section) for trl in trials]
+    if key is None:
+      return dict((k, [v[k] for v in values]) for k in values[0].keys()) if values else {}
+    return [v[key] for v in values]
+
+  def close(self):
+    if not self.fin.closed:
+      self.fin.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
@@ -1,5 +1,10 @@
 """
-Dumps trial data from bhv file into a csv file. The csv file structure is as follows:
+Dumps the trial data of bhv files into trial tables (see trialtable.py): binary
+.trials.npz files with the trial number, block, condition, result, reaction
+time, cycle rates, trial start time and the event codes and code times of every
+trial.
+
+With --csv a csv file is also written. The csv file structure is as follows:
 
 trial_no, block, condition, result, rt
 
@@ -9,15 +14,27 @@ python ~/bin/pyinstaller-2.0/pyinstaller.py -F -c '/Users/kghose/Research/2008-2
 
 import matplotlib
 matplotlib.use('macosx')
-import argparse, glob, os, bhv_read as brd, logging
+import argparse, csv, glob, os, trialtable as tt, logging
 logger = logging.getLogger(__name__)
 
 
+def write_csv(table, fout):
+  with open(fout, 'wb') as csvfile:
+    print 'Writing {:s}'.format(fout)
+    writer = csv.writer(csvfile)
+    writer.writerow(['Trial no', 'Block no', 'Condition no', 'Trial error', 'reaction time'])
+    writer.writerows(zip(table['TrialNumber'], table['BlockNumber'], table['ConditionNumber'], table['TrialError'],
+                         table['ReactionTime']))
+
+
 if __name__ == "__main__":
 
   parser = argparse.ArgumentParser(description=__doc__)
   parser.add_argument('-f','--file', help='Convert a single file')
   parser.add_argument('-d', '--dir', help='Convert whole directory')
+  parser.add_argument('-p', '--processes', type=int, default=None, help='Number of processes to use for a directory (default: all cores)')
+  parser.add_argument('--force', action="store_true", default=False, help="Reconvert files that have an up to date trial table")
+  parser.add_argument('--csv', action="store_true", default=False, help="Also write a csv file")
   parser.add_argument('-v','--verbose', action="store_true", default=False, help="Print logger messages")
 
   args = parser.parse_args()
@@ -28,22 +45,17 @@ if __name__ == "__main__":
   logging.basicConfig(level=level)
 
   if args.file is not None:
+    print 'Converting {:s}'.format(args.file)
+    tt.convert(args.file)
     file_list = [args.file]
   elif args.dir is not None:
+    tt.convert_all(args.dir, processes=args.processes, force=args.force)
     file_list = glob.glob(os.path.join(args.dir, '*.bhv'))
   else:
     parser.print_help()
     file_list = []
 
-  for file in file_list:
-    print 'Converting {:s}'.format(file)
-    bhv = brd.read_bhv(fname = file)
-
-    fout = file.replace('.bhv','.csv')
-    import csv
-    with open(fout, 'wb') as csvfile:
-      print 'Writing {:s}'.format(fout)
-      writer = csv.writer(csvfile)
-      writer.writerow(['Trial no', 'Block no', 'Condition no', 'Trial error', 'reaction time'])
-      for tn,blk,cond,res,rt in zip(bhv['TrialNumber'], bhv['BlockNumber'], bhv['ConditionNumber'], bhv['TrialError'], bhv['ReactionTime']):
-        writer.writerow([tn, blk, cond, res, rt])
+  if args.csv:
+    for file in file_list:
+      if os.path.exists(tt.table_name(file)):
+        write_csv(tt.load_trial_table(tt.table_name(file)), file.replace('.bhv','.csv'))
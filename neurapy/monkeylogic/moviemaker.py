@@ -1,17 +1,20 @@
 """This module (that can be run as a script) reads in a .bhv file and lets you
 make movies of the monkey's eye position behavior. Movies of single trials or a
-range of trials can be made. Sequentially numbered frames are dumped into a
-temporary directory and ffmpeg is used to stitch them together into a movie.
+range of trials can be made. Frames are rasterized straight into RGB arrays
+(the task objects are scaled once and pasted into each frame) by a pool of
+worker processes and piped, as raw video, into ffmpeg.
 
 Right now, the movie does not handle TTL objects and movies
 """
 import matplotlib
 matplotlib.use("Agg") #Don't need to see the frames
-import pylab, bhv_read as brd, logging, tempfile, re, argparse, os, subprocess
+import pylab, bhv_read as brd, logging, re, argparse, os, subprocess
+from multiprocessing import Pool
 logger = logging.getLogger(__name__)
 
-def parse_task_object_data(bhv):
-  """Convert all the objects into image data and parse their initial positions."""
+def parse_task_object_data(bhv, cond=0):
+  """Convert all the objects of a condition into image data and parse their
+  initial positions."""
   obj_data = bhv['Stimuli']['Pic'] #Only handling pics now
   obj_r = re.compile("(\w+)\(") #Regexp to find task object description
   args_r = re.compile("([-.\w]+)[,\)]")#Regexp to extract arguments
@@ -20,13 +23,13 @@ def parse_task_object_data(bhv):
   objects = []
   initial_pos = []
   for n in xrange(len(to)):
-    oname = obj_r.findall(to[n][0])[0]
+    oname = obj_r.findall(to[n][cond])[0]
     if oname == 'fix':
       odata = pylab.ones((5,5,3),dtype=float)#Arbitrary square for FP
-      args = args_r.findall(to[n][0])
+      args = args_r.findall(to[n][cond])
       p = [float(p) for p in args]
     elif oname =='pic':
-      args = args_r.findall(to[n][0])
+      args = args_r.findall(to[n][cond])
       picname = args[0] #First one is object name
       p = [float(p) for p in args[1:]]
       for oidx in xrange(len(obj_data)):
@@ -42,6 +45,63 @@ def parse_task_object_data(bhv):
 
   return objects, pylab.array(initial_pos)
 
+def object_timeline(osr_status, osr_time, osr_data, pos, tframe):
+  """Work out, for every frame, which objects are visible and where they are.
+
+  Each object status record event takes effect from the first frame at or after
+  its time. For each object we list the frames at which its visibility or its
+  position change (and the new values), then expand these change points to all
+  the frames with searchsorted, carrying each value forward until the next
+  change. Events at the same frame are applied in order.
+
+  Inputs:
+    osr_status, osr_time, osr_data - the object status record of the trial
+    pos - objects x 2 array of initial object positions
+    tframe - frame times (ms)
+  Outputs:
+    visible - frames x objects (1 visible, 0 not)
+    position - frames x objects x 2, xy position in degrees
+  """
+  fcount = tframe.size
+  ocount = pos.shape[0]
+  visible = pylab.zeros((fcount, ocount))
+  position = pylab.zeros((fcount, ocount, 2))
+  ev_frame = pylab.searchsorted(tframe, pylab.asarray(osr_time, dtype=float), side='left')
+
+  vis_frames = [[] for n in xrange(ocount)]
+  vis_values = [[] for n in xrange(ocount)]
+  pos_frames = [[] for n in xrange(ocount)]
+  pos_values = [[] for n in xrange(ocount)]
+  cur_pos = pylab.array(pos, dtype=float)
+  for ev in xrange(len(osr_time)):
+    if ev_frame[ev] >= fcount: #Happens after the last frame
+      break
+    for n,ojst in enumerate(osr_status[ev]):
+      if ojst == 0: #Switch it off
+        vis_frames[n].append(ev_frame[ev])
+        vis_values[n].append(0)
+      elif ojst == 1: #Switch it on
+        vis_frames[n].append(ev_frame[ev])
+        vis_values[n].append(1)
+        pos_frames[n].append(ev_frame[ev])
+        pos_values[n].append(cur_pos[n].copy())
+      elif ojst == 2: #Move it
+        cur_pos[n,:] = osr_data[ev][0]
+        pos_frames[n].append(ev_frame[ev])
+        pos_values[n].append(cur_pos[n].copy())
+
+  frames = pylab.arange(fcount)
+  for n in xrange(ocount):
+    if vis_frames[n]:
+      idx = pylab.searchsorted(vis_frames[n], frames, side='right') - 1 #Last change at or before each frame
+      values = pylab.concatenate(([0], vis_values[n])) #Before the first change the object is off
+      visible[:,n] = values[idx + 1]
+    if pos_frames[n]:
+      idx = pylab.searchsorted(pos_frames[n], frames, side='right') - 1
+      values = pylab.concatenate((pylab.zeros((1,2)), pos_values[n]))
+      position[:,n,:] = values[idx + 1]
+  return visible, position
+
 def prepare_trial(bhv, trl, options):
   """From the bhv file extract all the information necessary for plotting a
   trial.
@@ -67,7 +127,7 @@ def prepare_trial(bhv, trl, options):
   eyey = bhv['YEye'][trl]
   fs = bhv['AnalogInputFrequency']
 
-  objects, pos = parse_task_object_data(bhv)
+  objects, pos = parse_task_object_data(bhv, bhv['ConditionNumber'][trl] - 1)
   ocount = len(objects)
   object_size = pylab.zeros((ocount,2))
   for n in xrange(ocount):
@@ -92,33 +152,16 @@ def prepare_trial(bhv, trl, options):
   #index 2 -> [0] - visible (1) or not (0)
   #           [1,2] - xy position in degrees
 
-  cur_ev = 0 #This keeps track of which is the next event in the object status record we are hoing to hit
-
   #Fill in the eye data
   frame_data[:,0,0] = 1 #Eye is always present
   frame_data[:,0,1] = eyex_i
   frame_data[:,0,2] = eyey_i
 
-  for fr in xrange(fcount):
-    while tframe[fr] >= osr_time[cur_ev]:
-      for n,ojst in enumerate(osr_status[cur_ev]):
-        if ojst == 0:
-          frame_data[fr:,n+1,0] = 0 #Switch it off
-        elif ojst == 1:
-          frame_data[fr:,n+1,0] = 1 #Switch it on
-          frame_data[fr:,n+1,1:] = pos[n,:]
-        elif ojst == 2: #Move it
-          pos[n,:] = osr_data[cur_ev][0]
-          frame_data[fr:,n+1,1:] = pos[n,:]
-      cur_ev += 1
-      if cur_ev >= len(osr_time):
-        break
-
-    if cur_ev >= len(osr_time):
-      break
+  frame_data[:,1:,0], frame_data[:,1:,1:] = object_timeline(osr_status, osr_time, osr_data, pos, tframe)
 
   movie_data = {
     'speed': options['speed'],
+    'scale': options.get('scale', 1.0),
     'screen color': scr_col,
     'screen size': scr_size,
     'pixels per degree': ppd,
@@ -132,60 +175,152 @@ def prepare_trial(bhv, trl, options):
   return movie_data
 
 
-def single_frame(movie_data, frame_no):
-  """Do the dirty work of converting the movie data into a plot of a single frame."""
-  speed = movie_data['speed']
-  t_ms = movie_data['tframe'][frame_no] - movie_data['tstart']
-  scr_col = movie_data['screen color']
+def scale_objects(movie_data):
+  """Resample each object image (nearest neighbour) to the size, in output
+  pixels, it has on the screen, as an RGB uint8 array. As with imshow, the
+  first axis of the image runs down the screen."""
+  px = movie_data['pixels per degree'] * movie_data['scale']
+  scaled = []
+  for img, (w, h) in zip(movie_data['objects'], movie_data['object size']):
+    w_px = max(1, int(round(w * px)))
+    h_px = max(1, int(round(h * px)))
+    rows = pylab.arange(h_px) * img.shape[0] // h_px
+    cols = pylab.arange(w_px) * img.shape[1] // w_px
+    scaled.append((pylab.clip(img[rows][:, cols, :3], 0, 1) * 255).round().astype(pylab.uint8))
+  return scaled
+
+def frame_size(movie_data):
+  """Output frame (width, height) in pixels, rounded down to even numbers for
+  the video codec"""
+  px = movie_data['pixels per degree'] * movie_data['scale']
   sx, sy = movie_data['screen size']
-  objects = movie_data['objects']
-  osize = movie_data['object size']
-
-  pylab.plot([-sx/2, sx/2, sx/2, -sx/2, -sx/2],[sy/2, sy/2, -sy/2, -sy/2, sy/2],'k')
-  ax = pylab.gca()
+  return 2*max(1, int(sx * px / 2)), 2*max(1, int(sy * px / 2))
+
+def paste(frame, img, r0, c0):
+  """Copy img into frame with its top left corner at (r0, c0), clipping at the
+  edges of the frame"""
+  H, W = frame.shape[:2]
+  h, w = img.shape[:2]
+  r1, c1 = max(r0, 0), max(c0, 0)
+  r2, c2 = min(r0 + h, H), min(c0 + w, W)
+  if r1 < r2 and c1 < c2:
+    frame[r1:r2, c1:c2] = img[r1-r0:r2-r0, c1-c0:c2-c0]
+
+def render_frame(movie_data, frame_no, scaled_objects=None):
+  """Rasterize one frame into an RGB (rows x cols x 3, uint8) array. Screen
+  coordinates are in degrees with the origin at the center and y up.
+  scaled_objects is the output of scale_objects(movie_data). Pass it in when
+  rendering many frames, so the objects are only scaled once."""
+  if scaled_objects is None:
+    scaled_objects = scale_objects(movie_data)
+  px = movie_data['pixels per degree'] * movie_data['scale']
+  sx, sy = movie_data['screen size']
+  W, H = frame_size(movie_data)
+  def col(x):
+    return int(round((x + sx/2.0) * px))
+  def row(y):
+    return int(round((sy/2.0 - y) * px))
+
+  frame = pylab.empty((H, W, 3), dtype=pylab.uint8)
+  frame[:] = (pylab.clip(movie_data['screen color'], 0, 1) * 255).round().astype(pylab.uint8)
   fd = movie_data['frame data'][frame_no, :, :]
   for n in xrange(fd.shape[0]-1,0,-1): #Need to go backwards to ensure proper z-stack for plotting. Objects earlier in the conditions file obscure later objects
     if fd[n,0]:#Show this image
-      cx = fd[n,1]
-      cy = fd[n,2]
-      ext = [cx - osize[n-1,0]/2, cx + osize[n-1,0]/2,
-             -cy + osize[n-1,1]/2, -cy - osize[n-1,1]/2]#l,r,b,t
-      pylab.imshow(objects[n-1], extent=ext, interpolation='none')
-
-  pylab.plot(fd[0,1], -fd[0,2], 'w.')  #Plot eye position
-
-  pylab.plot([8, 10, 10], [10, 10, 8], 'y-') #Scale bar
-  pylab.text(9, 9, r'$2^{o}$', size=6, horizontalalignment='center', verticalalignment='center',) #Scale bar text
-
-  pylab.text(-0.99*sx/2,0.99*sy/2, '{:04.0f} ms  (x{:1.2f})'.format(t_ms, speed), name='mono', size=7)#Frame info
-
-  pylab.axis('scaled')
-  pylab.setp(ax, 'xticks', [], 'yticks', [], 'axis_bgcolor', scr_col, 'ylim',[sy/2, -sy/2], 'xlim', [-sx/2, sx/2])#Ensures reversed y-axis uniformly (otherwise images will flip y-axis w/o warning)
-
-
-def play(movie_data):
-  """Cycle through all the frames, save them as needed."""
-  tdir = tempfile.mkdtemp(suffix='_ml_momkr') #Temporary directory for frames
-  logger.debug('Frames are being placed in ' + tdir)
-
-  for fr in xrange(movie_data['tframe'].size):
-    pylab.figure()
-    single_frame(movie_data, frame_no=fr)
-    fname = tdir + '/frame{:05d}.png'.format(fr)
-    pylab.savefig(fname)
-    pylab.close()
-
-  ffmpeg_command = ['ffmpeg','-i', tdir + '/frame%05d.png', '-vcodec', 'libx264', '-x264opts', 'keyint=123:min-keyint=20', '-r', str(options['fps']), '-an', '-y', '-f', 'avi', options['movie name']]
+      img = scaled_objects[n-1]
+      paste(frame, img, row(fd[n,2]) - img.shape[0]//2, col(fd[n,1]) - img.shape[1]//2)
+
+  if pylab.isfinite(fd[0,1:]).all(): #Eye position
+    r = max(1, int(round(px * 0.1))) #Marker half width, 0.1 deg
+    paste(frame, 255*pylab.ones((2*r+1, 2*r+1, 3), dtype=pylab.uint8), row(fd[0,2]) - r, col(fd[0,1]) - r)
+
+  yellow = pylab.array([255, 255, 0], dtype=pylab.uint8) #2 deg scale bar, bottom right
+  paste(frame, pylab.tile(yellow, (1, col(10) - col(8) + 1, 1)), row(-10), col(8))
+  paste(frame, pylab.tile(yellow, (row(-10) - row(-8) + 1, 1, 1)), row(-8), col(10))
+  return frame
+
+#Each worker process gets its own copy of the movie data once, when the pool is
+#started, rather than with every frame, and scales the objects once
+worker_movie_data = None
+worker_scaled_objects = None
+
+def init_worker(movie_data):
+  global worker_movie_data, worker_scaled_objects
+  worker_movie_data = movie_data
+  worker_scaled_objects = [scale_objects(md) for md in movie_data]
+
+def render_job(job):
+  n, frame_no = job
+  return render_frame(worker_movie_data[n], frame_no, worker_scaled_objects[n]).tostring()
+
+def play(movie_data, options):
+  """Render all the frames and pipe them into ffmpeg.
+  Inputs:
+    movie_data - a movie data dictionary (prepare_trial) or a list of them (the
+                 trials are joined, in order, into one movie)
+    options - dictionary with 'fps', 'movie name' and, optionally,
+              'processes' (number of rendering processes, None for all cores)
+  """
+  if isinstance(movie_data, dict):
+    movie_data = [movie_data]
+  W, H = frame_size(movie_data[0])
+  for md in movie_data[1:]:
+    if frame_size(md) != (W, H):
+      raise ValueError('All trials must have the same frame size')
+  jobs = [(n, fr) for n in xrange(len(movie_data)) for fr in xrange(movie_data[n]['tframe'].size)]
+  logger.debug('{:d} frames of {:d}x{:d}'.format(len(jobs), W, H))
+
+  ffmpeg_command = ['ffmpeg', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{:d}x{:d}'.format(W, H),
+                    '-r', str(options['fps']), '-i', '-',
+                    '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', '-x264opts', 'keyint=123:min-keyint=20',
+                    '-an', '-y', '-f', 'avi', options['movie name']]
   logger.debug(ffmpeg_command)
-  if subprocess.call(ffmpeg_command) is 0:
+  ffmpeg = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE)
+
+  processes = options.get('processes')
+  pool = None
+  finished = False
+  try:
+    if processes == 1:
+      init_worker(movie_data)
+      frames = (render_job(job) for job in jobs)
+    else:
+      pool = Pool(processes=processes, initializer=init_worker, initargs=(movie_data,))
+      frames = pool.imap(render_job, jobs, chunksize=16)
+    for frame in frames:
+      ffmpeg.stdin.write(frame)
+    finished = True
+  finally:
+    if processes == 1:
+      init_worker([]) #Don't hold on to the movie data
+    if pool is not None:
+      if finished:
+        pool.close()
+      else: #ffmpeg quit, a frame failed to render or we were interrupted
+        pool.terminate()
+      pool.join()
+    if not finished:
+      ffmpeg.kill()
+      try:
+        ffmpeg.stdin.close()
+      except IOError:
+        pass
+      ffmpeg.wait()
+      logger.error('movie creation aborted')
+  ffmpeg.stdin.close()
+  if ffmpeg.wait() == 0:
     logger.debug('movie creation successful')
+  else:
+    logger.error('ffmpeg failed')
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument('-f','--file', help=".bhv file full path")
   parser.add_argument('-t', '--trial', help="Trial number", default=0, type=int)
+  parser.add_argument('-l', '--last', help="Last trial number, to make one movie of a range of trials", default=None, type=int)
   parser.add_argument('-x', '--speed', help="Speed multiplier of movie relative to actual speed", default=1.0, type=float)
   parser.add_argument('--fps', help="fps of video", default=25.0, type=float)
+  parser.add_argument('-s', '--scale', help="Size of the movie relative to the screen resolution", default=0.5, type=float)
+  parser.add_argument('-p', '--processes', help="Number of rendering processes (default: all cores)", default=None, type=int)
   parser.add_argument('-v','--verbose', action="store_true", default=False, help="Print logger messages")
   args = parser.parse_args()
 
@@ -195,13 +330,20 @@ if __name__ == "__main__":
     level = logging.ERROR
   logging.basicConfig(level=level)
 
+  last = args.trial if args.last is None else args.last
+  if last == args.trial:
+    tag = '_t{:04d}'.format(args.trial)
+  else:
+    tag = '_t{:04d}-{:04d}'.format(args.trial, last)
   options = {
     'speed': args.speed,
     'tstep': (1000* args.speed)/args.fps,
-    'movie name': os.path.basename(args.file)[:-4] + '_t{:04d}_{:1.1f}.avi'.format(args.trial, args.speed),
-    'fps': args.fps
+    'movie name': os.path.basename(args.file)[:-4] + tag + '_{:1.1f}.avi'.format(args.speed),
+    'fps': args.fps,
+    'scale': args.scale,
+    'processes': args.processes
   }
 
   bhv = brd.read_bhv(fname = args.file)
-  movie_data = prepare_trial(bhv, args.trial - 1, options)
-  play(movie_data)
\ No newline at end of file
+  movie_data = [prepare_trial(bhv, trl - 1, options) for trl in xrange(args.trial, last + 1)]
+  play(movie_data, options)
@@ -0,0 +1,150 @@
+"""Trial tables: the trial level data of a .bhv file as arrays, saved in a compact binary file that loads almost
+instantly.
+
+A trial table is a dictionary with one array per column
+  TrialNumber, BlockNumber, ConditionNumber, TrialError, ReactionTime, CycleRate, MinCycleRate - one entry per trial
+  AbsoluteTrialStartTime - trials x n array (nan padded)
+  CodeNumbers, CodeTimes - the event codes of all the trials, concatenated
+  CodeOffsets - the codes of trial tr are CodeNumbers[CodeOffsets[tr]:CodeOffsets[tr+1]]
+Only the trial scalars and the codes are decoded (see bhv_read.BhvFile), so the analog data is never read.
+
+e.g.
+  from neurapy.monkeylogic import trialtable as tt
+  tt.convert_all('/data/bhv', processes=8) -> writes x.trials.npz next to each x.bhv
+  T = tt.load_trial_tables(glob.glob('/data/bhv/*.trials.npz'))
+  T['TrialError'][T['Session'] == 3]
+  codes = tt.codes(T)
+  codes[10] -> event codes of trial 10
+"""
+import glob, logging, os, time, numpy, pylab
+from multiprocessing import Pool
+import bhv_read as brd
+from neurapy.utility.ragged import RaggedArray
+logger = logging.getLogger(__name__)
+
+scalar_columns = ['TrialNumber', 'BlockNumber', 'ConditionNumber', 'TrialError', 'ReactionTime', 'CycleRate',
+                  'MinCycleRate']
+
+
+def trial_table(fname):
+  """Build the trial table of a .bhv file."""
+  with brd.BhvFile(fname) as bf:
+    table = dict((key, bf.field(key)) for key in scalar_columns)
+    atst = bf.field('AbsoluteTrialStartTime')
+    ncol = max([len(t) for t in atst if t is not None] + [0])
+    table['AbsoluteTrialStartTime'] = pylab.nan * pylab.ones((len(bf), ncol))
+    for trl, t in enumerate(atst):
+      if t is not None:
+        table['AbsoluteTrialStartTime'][trl, :len(t)] = t
+    codes = [bf.read_section(trl, 'codes') for trl in xrange(len(bf))] #Numbers and times in one read
+  code_numbers = [c['CodeNumbers'] for c in codes]
+  code_times = [c['CodeTimes'] for c in codes]
+  table['CodeOffsets'] = pylab.concatenate(([0], pylab.cumsum([len(c) for c in code_numbers]))).astype(pylab.int64)
+  table['CodeNumbers'] = pylab.fromiter((c for trl in code_numbers for c in trl), dtype=pylab.uint16,
+                                        count=table['CodeOffsets'][-1])
+  table['CodeTimes'] = pylab.fromiter((t for trl in code_times for t in trl), dtype=pylab.uint32,
+                                      count=table['CodeOffsets'][-1])
+  return table
+
+
+def table_name(fname):
+  return fname.replace('.bhv', '.trials.npz')
+
+
+def save_trial_table(table, fout):
+  with open(fout, 'wb') as f:
+    numpy.savez(f, **table)
+
+
+def load_trial_table(fname):
+  """Load a trial table saved by convert."""
+  with numpy.load(fname) as npz:
+    return dict(npz.items())
+
+
+def codes(table):
+  """The event codes and code times of each trial as RaggedArrays"""
+  return RaggedArray(table['CodeNumbers'], table['CodeOffsets']), RaggedArray(table['CodeTimes'], table['CodeOffsets'])
+
+
+def convert(fname):
+  """Build the trial table of fname and save it next to it (.bhv -> .trials.npz). Returns the table."""
+  table = trial_table(fname)
+  save_trial_table(table, table_name(fname))
+  return table
+
+
+def convert_one(fname):
+  """Worker for convert_all. Returns (fname, seconds, error or None)"""
+  t0 = time.time()
+  try:
+    convert(fname)
+  except Exception as e:
+    return fname, time.time() - t0, str(e)
+  return fname, time.time() - t0, None
+
+
+def convert_all(dir='.', processes=None, force=False):
+  """Convert all the .bhv files in a directory to trial tables, in parallel. Files whose trial table is newer than
+  the .bhv file are skipped unless force is True.
+
+  Inputs:
+    dir - directory with the .bhv files
+    processes - number of worker processes. None uses all the cores, 1 converts in this process
+    force - if True reconvert everything
+  Outputs:
+    list of the files converted
+  """
+  fnames = [f for f in sorted(glob.glob(os.path.join(dir, '*.bhv')))
+            if force or not os.path.exists(table_name(f)) or os.path.getmtime(table_name(f)) < os.path.getmtime(f)]
+  logger.info('Converting {:d} files'.format(len(fnames)))
+  if processes == 1 or len(fnames) < 2:
+    results = [convert_one(f) for f in fnames]
+  else:
+    pool = Pool(processes=processes)
+    results = pool.map(convert_one, fnames)
+    pool.close()
+    pool.join()
+
+  converted = []
+  for fname, seconds, error in results:
+    if error is not None:
+      logger.error('{:s}: {:s}'.format(fname, error))
+    else:
+      logger.info('{:s}: {:1.2f} s'.format(fname, seconds))
+      converted.append(fname)
+  return converted
+
+
+def load_trial_tables(fnames, concatenate=True):
+  """Load many trial tables.
+
+  Inputs:
+    fnames - list of .trials.npz files
+    concatenate - if True, merge them into one table with an extra 'Session' column (index into fnames), with the
+                  code offsets adjusted to the merged code arrays. Otherwise return a list of tables
+  """
+  if not len(fnames):
+    raise ValueError('No trial tables to load')
+  tables = [load_trial_table(f) for f in fnames]
+  if not concatenate:
+    return tables
+  merged = {}
+  for key in scalar_columns + ['CodeNumbers', 'CodeTimes']:
+    merged[key] = pylab.concatenate([t[key] for t in tables])
+  merged['Session'] = pylab.concatenate([pylab.ones(t['TrialNumber'].size, dtype=int)*n
+                                         for n, t in enumerate(tables)])
+  ncol = max([t['AbsoluteTrialStartTime'].shape[1] for t in tables] + [0])
+  merged['AbsoluteTrialStartTime'] = pylab.nan * pylab.ones((merged['TrialNumber'].size, ncol))
+  row = 0
+  for t in tables:
+    r, c = t['AbsoluteTrialStartTime'].shape
+    merged['AbsoluteTrialStartTime'][row:row + r, :c] = t['AbsoluteTrialStartTime']
+    row += r
+  code_offsets = [pylab.zeros(1, dtype=pylab.int64)]
+  base = 0
+  for t in tables:
+    code_offsets.append(t['CodeOffsets'][1:] + base)
+    base += t['CodeOffsets'][-1]
+  merged['CodeOffsets'] = pylab.concatenate(code_offsets)
+  return merged
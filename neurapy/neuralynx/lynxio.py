@@ -4,6 +4,37 @@ from struct import unpack as upk, pack as pk, calcsize as csize
 import logging, pylab
 logger = logging.getLogger(__name__)
 
+#Record formats of the files Cheetah writes
+csc_packet = pylab.dtype([
+  ('timestamp', 'Q'),
+  ('chan', 'I'),
+  ('Fs', 'I'),
+  ('Ns', 'I'),
+  ('samp', '512h')
+])
+
+nev_packet = pylab.dtype([
+  ('nstx', 'h'),
+  ('npkt_id', 'h'),
+  ('npkt_data_size', 'h'),
+  ('timestamp', 'Q'),
+  ('eventid', 'h'),
+  ('nttl', 'H'),
+  ('ncrc', 'h'),
+  ('ndummy1', 'h'),
+  ('ndummy2', 'h'),
+  ('dnExtra', '8i'),
+  ('eventstring', '128c')
+])
+
+nse_packet = pylab.dtype([
+  ('timestamp', 'Q'),
+  ('saen', 'I'),
+  ('cellno', 'I'),
+  ('Features', '8I'),
+  ('waveform', '32h')
+])
+
 def read_header(fin):
   """Standard 16 kB header."""
   return fin.read(16*1024).strip('\00')
@@ -33,14 +64,6 @@ def read_csc(fin, assume_same_fs=True):
   sampling frequency has not changed during the recording
   """
   hdr = read_header(fin)
-  csc_packet = pylab.dtype([
-    ('timestamp', 'Q'),
-    ('chan', 'I'),
-    ('Fs', 'I'),
-    ('Ns', 'I'),
-    ('samp', '512h')
-  ])
-
   data = pylab.fromfile(fin, dtype=csc_packet, count=-1)
   Fs = None
   trace = None
@@ -119,19 +142,6 @@ def read_nev(fin, parse_event_string=False):
       'eventstring' - Only is parse_event_string is set to True. This is a nicely formatted eventstring
   """
   hdr = read_header(fin)
-  nev_packet = pylab.dtype([
-    ('nstx', 'h'),
-    ('npkt_id', 'h'),
-    ('npkt_data_size', 'h'),
-    ('timestamp', 'Q'),
-    ('eventid', 'h'),
-    ('nttl', 'H'),
-    ('ncrc', 'h'),
-    ('ndummy1', 'h'),
-    ('ndummy2', 'h'),
-    ('dnExtra', '8i'),
-    ('eventstring', '128c')
-  ])
   data = pylab.fromfile(fin, dtype=nev_packet, count=-1)
   logger.debug('{:d} events'.format(data['timestamp'].size))
   if parse_event_string:
@@ -166,45 +176,103 @@ def read_nse(fin):
   """
 
   hdr = read_header(fin)
-  nse_packet = pylab.dtype([
-    ('timestamp', 'Q'),
-    ('saen', 'I'),
-    ('cellno', 'I'),
-    ('Features', '8I'),
-    ('waveform', '32h')
-  ])
   data = pylab.fromfile(fin, dtype=nse_packet, count=-1)
   return {'header': hdr, 'packets': data}
 
 
-def write_nse(fname, time_stamps, remarks=''):
-  """Write out the given time stamps into a nse file."""
-  with open(fname,'wb') as fout:
-    fmt = '=QII8I32h'
-    dwScNumber = 1
-    dwCellNumber = 1
-    #dnParams = [0]*8
-    #snData = [0]*32
-    garbage = [0]*40
+class NSEFile:
+  """Lazy, memory mapped reader for single electrode spike (.nse) files.
 
-    header = remarks.ljust(16*1024,'\x00')
-    fout.write(header)
-    for ts in time_stamps:
-      fout.write(pk(fmt, ts, dwScNumber, dwCellNumber, *garbage))
+  Nothing but the header is read when the object is created. The records are memmapped and the fields are exposed as
+  column views, so asking for the timestamps does not pull the waveforms into memory. The first time we ask for a
+  particular cell the cell numbers are argsorted (stable, so each cell's spikes stay in time order) and we keep the
+  index around for subsequent calls.
 
-
-def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=64, max_pkts=-1, buffer_size=10000, error_bugout=1000000000):
+  e.g.
+    from neurapy.neuralynx import lynxio
+    nse = lynxio.NSEFile('TT1.nse')
+    nse.cells()           -> array of the cell numbers present in the file
+    nse.spikes_of(3)      -> timestamps (us) of cell 3
+    nse['waveform']       -> memmapped (N x 32) view of all the waveforms
+    nse.waveforms_of(3)   -> waveforms of cell 3 (only these records are read)
+  """
+  def __init__(self, fname):
+    self.fname = fname
+    with open(fname, 'rb') as fin:
+      self.header = read_header(fin)
+      fin.seek(0, 2)
+      data_bytes = fin.tell() - 16*1024
+    n_packets = max(0, data_bytes) / nse_packet.itemsize
+    if n_packets:
+      self.packets = pylab.memmap(fname, dtype=nse_packet, mode='r', offset=16*1024, shape=(n_packets,))
+    else:
+      self.packets = pylab.zeros(0, dtype=nse_packet) #memmap refuses to map zero bytes
+    self.order = None
+    self.cell_index = None
+
+  def __len__(self):
+    return self.packets.size
+
+  def __getitem__(self, field):
+    """Column view of one of the fields ('timestamp', 'saen', 'cellno', 'Features', 'waveform')."""
+    return self.packets[field]
+
+  def build_index(self):
+    """Stable argsort of the cell numbers. After this, the spikes of each cell are a contiguous run of self.order"""
+    cellno = pylab.array(self.packets['cellno'])
+    self.order = cellno.argsort(kind='mergesort')
+    cells, start = pylab.unique(cellno[self.order], return_index=True)
+    stop = pylab.append(start[1:], cellno.size)
+    self.cell_index = dict((c, (st, nd)) for c, st, nd in zip(cells, start, stop))
+
+  def cells(self):
+    """Cell numbers present in the file."""
+    if self.cell_index is None: self.build_index()
+    return pylab.array(sorted(self.cell_index.keys()), dtype='I')
+
+  def indexes_of(self, cell):
+    """Record indexes (in time order) for the given cell. Empty if the cell is not in the file."""
+    if self.cell_index is None: self.build_index()
+    if cell not in self.cell_index:
+      return pylab.zeros(0, dtype=self.order.dtype)
+    st, nd = self.cell_index[cell]
+    return self.order[st:nd]
+
+  def spikes_of(self, cell):
+    """Timestamps (us) of the given cell."""
+    return self.packets['timestamp'][self.indexes_of(cell)]
+
+  def waveforms_of(self, cell):
+    """Waveforms (N x 32) of the given cell."""
+    return self.packets['waveform'][self.indexes_of(cell)]
+
+  def features_of(self, cell):
+    """Features (N x 8) of the given cell."""
+    return self.packets['Features'][self.indexes_of(cell)]
+
+
+def write_nse(fname, time_stamps, remarks='', waveforms=None, features=None, cellno=1):
+  """Write out the given time stamps (and optionally waveforms, features and cell numbers) into a nse file.
+  See lynxwrite for the full set of writers, including streaming ones."""
+  from neurapy.neuralynx import lynxwrite
+  lynxwrite.write_nse(fname, time_stamps, waveforms=waveforms, features=features, cellno=cellno, remarks=remarks)
+
+
+def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=64, max_pkts=-1, buffer_size=10000, error_bugout=1000000000, stage=None):
   """Read and write out selected raw traces from the .nrd file with error checking.
   Inputs:
     fname - name of nrd file
     ftsname - name under which timestamp vector will be saved
     fttlname - name under which the events will be saved
-    fchanname - a list of file names for the
+    fchanname - a list of file names for the raw channels. If None, the raw channels are not written out
     channel_list - Which AD channels to convert.
     channels - total channels in the system
     max_pkts - total packets to read. If set to -1 then read all packets
     buffer_size   - how many chunks to read at a time.
     error_bugout - If the sum of stx, crc and timestamp errors exceed this value quit reading the file
+    stage - optional pipeline stage (e.g. continuous.BandSplitter). Every good block of packets is handed to
+            stage.process as a (samples x len(channel_list)) array while it is still in memory and stage.close is
+            called at the end
   Outputs:
     Data are written to file
 
@@ -227,6 +295,14 @@ def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=6
   Data are written as a pure stream of binary data and can be easily and efficiently read using the numpy read function.
   For convenience, a function that reads the timestamps, events and channels (read_extracted_data) is included in the library.
 
+  To split the channels into LFP and spike bands during the extraction, instead of writing out the raw channels and
+  filtering the files afterwards, pass a stage:
+  ----------------------------------------------------------------------------------------------------------------------
+  from neurapy.signal import continuous as cc
+  bs = cc.BandSplitter(32556, ['lfp_{:03d}.raw'.format(ch) for ch in channel_list],
+                       ['spike_{:03d}.raw'.format(ch) for ch in channel_list])
+  lynxio.extract_nrd_ec(fname, ftsname, fttlname, None, channel_list, channels, stage=bs)
+  ----------------------------------------------------------------------------------------------------------------------
   """
   def seek_packet(f):
     """Skip forward until we find the STX magic number."""
@@ -273,7 +349,7 @@ def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=6
   #The files we will write to.
   fts = open(ftsname,'wb')
   fttl = open(fttlname,'wb')
-  fchan = [open(fcn,'wb') for fcn in fchanname]
+  fchan = [open(fcn,'wb') for fcn in fchanname] if fchanname is not None else []
 
   last_ts = 0L
   with open(fname,'rb') as f:
@@ -343,8 +419,10 @@ def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=6
         last_ts = ts[-1] #Ready for the next read
         ts.tofile(fts)
         these_packets['ttl'].tofile(fttl)
-        for idx,ch in enumerate(channel_list):
-          these_packets['data'][:,ch].tofile(fchan[idx])
+        for fch, ch in zip(fchan, channel_list):
+          these_packets['data'][:,ch].tofile(fch)
+        if stage is not None:
+          stage.process(these_packets['data'][:,channel_list])
 
       pkt_cnt += these_packets.size
       if max_pkts != -1:
@@ -364,6 +442,8 @@ def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=6
   fts.close()
   fttl.close()
   [fch.close() for fch in fchan]
+  if stage is not None:
+    stage.close()
 
   logger.info('Extracted {:d} packets'.format(pkt_cnt))
   logger.info('{:d} garbage words'.format(garbage_bytes))
@@ -375,17 +455,18 @@ def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=6
 
 
 
-def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels=64, max_pkts=-1, buffer_size=10000):
+def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels=64, max_pkts=-1, buffer_size=10000, stage=None):
   """Read and write out selected raw traces from the .nrd file.
   Inputs:
     fname - name of nrd file
     ftsname - name under which timestamp vector will be saved
     fttlname - name under which the events will be saved
-    fchanname - a list of file names for the
+    fchanname - a list of file names for the raw channels. If None, the raw channels are not written out
     channel_list - Which AD channels to convert.
     channels - total channels in the system
     max_pkts - total packets to read. If set to -1 then read all packets
     buffer_size   - how many chunks to read at a time.
+    stage - optional pipeline stage, see extract_nrd_ec
   Outputs:
     Data are written to file
 
@@ -437,7 +518,7 @@ def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels
   #The files we will write to. fixme: test for properly opened?
   fts = open(ftsname,'wb')
   fttl = open(fttlname,'wb')
-  fchan = [open(fcn,'wb') for fcn in fchanname]
+  fchan = [open(fcn,'wb') for fcn in fchanname] if fchanname is not None else []
 
   with open(fname,'rb') as f:
     hdr = read_header(f)
@@ -456,8 +537,10 @@ def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels
       ts = pylab.array((these_packets['timestamp high']<<32) | (these_packets['timestamp low']), dtype='uint64')
       ts.tofile(fts)
       these_packets['ttl'].tofile(fttl)
-      for idx,ch in enumerate(channel_list):
-        these_packets['data'][:,ch].tofile(fchan[idx])
+      for fch, ch in zip(fchan, channel_list):
+        these_packets['data'][:,ch].tofile(fch)
+      if stage is not None:
+        stage.process(these_packets['data'][:,channel_list])
 
       pkt_cnt += these_packets.size
       if max_pkts != -1:
@@ -468,6 +551,8 @@ def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels
   fts.close()
   fttl.close()
   [fch.close() for fch in fchan]
+  if stage is not None:
+    stage.close()
 
   logger.info('Extracted {:d} packets'.format(pkt_cnt))
 
@@ -0,0 +1,188 @@
+"""Functions and classes to write Neuralynx .nse, .ncs and .nev files, e.g. to send spikes we have re-sorted, or data we
+have processed, back into the Neuralynx tools.
+
+Each record type has a writer class that takes whole arrays of data, packs them into a structured array (using the
+record formats in lynxio) and dumps them with a single tofile call. The writers can be opened in append mode and fed
+successive blocks of data, so data sets bigger than memory can be streamed out.
+
+e.g.
+  from neurapy.neuralynx import lynxwrite
+  lynxwrite.write_nse('TT1_sorted.nse', ts, waveforms=wv, cellno=cells)
+
+  with lynxwrite.NCSWriter('CSC1_lfp.ncs', Fs=1017, t0=x['t0']) as w:
+    for block in blocks:
+      w.append(block)
+"""
+import os, logging, pylab
+from neurapy.neuralynx.lynxio import csc_packet, nev_packet, nse_packet
+logger = logging.getLogger(__name__)
+
+header_len = 16*1024
+
+def write_header(fout, remarks=''):
+  """Write the standard 16 kB header (free text padded with nulls)."""
+  if len(remarks) > header_len:
+    logger.warning('Header remarks truncated to {:d} bytes'.format(header_len))
+  fout.write(remarks[:header_len].ljust(header_len, '\x00'))
+
+
+class NeuralynxWriter:
+  """Base class for the writers. Opens the file and writes the header. If append is True and the file already has a
+  header we just add records to the end of it."""
+  def __init__(self, fname, remarks='', append=False):
+    self.fname = fname
+    if append and os.path.exists(fname) and os.path.getsize(fname) >= header_len:
+      self.fout = open(fname, 'ab')
+    else:
+      self.fout = open(fname, 'wb')
+      write_header(self.fout, remarks)
+    self.records_written = 0
+
+  def write_records(self, records):
+    records.tofile(self.fout)
+    self.records_written += records.size
+
+  def close(self):
+    if not self.fout.closed:
+      self.fout.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+class NSEWriter(NeuralynxWriter):
+  """Writes single electrode spike records."""
+  def append(self, timestamps, waveforms=None, features=None, cellno=1, saen=1):
+    """
+    Inputs:
+      timestamps - N array of spike times (us)
+      waveforms - N x 32 array of spike waveforms (A/D units). Zeros if None
+      features - N x 8 array of features. Zeros if None
+      cellno - scalar or N array of cell numbers
+      saen - scalar or N array of spike acquisition entity numbers
+    """
+    timestamps = pylab.asarray(timestamps)
+    records = pylab.zeros(timestamps.size, dtype=nse_packet)
+    records['timestamp'] = timestamps
+    records['saen'] = saen
+    records['cellno'] = cellno
+    if features is not None:
+      records['Features'] = features
+    if waveforms is not None:
+      records['waveform'] = waveforms
+    self.write_records(records)
+
+
+class NEVWriter(NeuralynxWriter):
+  """Writes event records."""
+  def append(self, timestamps, ttl, eventid=0, eventstring=None, nstx=800, npkt_id=4098, npkt_data_size=2):
+    """
+    Inputs:
+      timestamps - N array of event times (us)
+      ttl - scalar or N array of TTL port values
+      eventid - scalar or N array of event ids
+      eventstring - None, a string or a list of N strings (at most 128 characters)
+      nstx, npkt_id, npkt_data_size - record header words
+    """
+    timestamps = pylab.asarray(timestamps)
+    records = pylab.zeros(timestamps.size, dtype=nev_packet)
+    records['nstx'] = nstx
+    records['npkt_id'] = npkt_id
+    records['npkt_data_size'] = npkt_data_size
+    records['timestamp'] = timestamps
+    records['eventid'] = eventid
+    records['nttl'] = ttl
+    if eventstring is not None:
+      if isinstance(eventstring, basestring):
+        eventstring = [eventstring] * timestamps.size
+      records['eventstring'] = pylab.array(eventstring, dtype='S128').view('c').reshape(-1, 128)
+    self.write_records(records)
+
+
+class NCSWriter(NeuralynxWriter):
+  """Writes continuously sampled records. Samples are packed into 512 sample packets. Samples that do not fill up a
+  packet are held back until the next append (or until close) so that a stream of arbitrarily sized blocks produces the
+  same file as one big block. Timestamps are computed from t0 and the sampling frequency.
+
+  t0 is the time (us) of the first sample. When appending to a file that already has records and t0 is None, the
+  samples carry on from the end of the last record in the file. A partially filled last packet of the earlier session
+  stays partially filled: the new samples start in a packet of their own."""
+  def __init__(self, fname, Fs, t0=None, chan=0, remarks='', append=False):
+    NeuralynxWriter.__init__(self, fname, remarks=remarks, append=append)
+    self.Fs = Fs
+    self.chan = chan
+    if t0 is None:
+      t0 = 0
+      if self.fout.mode == 'ab' and os.path.getsize(fname) >= header_len + csc_packet.itemsize:
+        with open(fname, 'rb') as fin:
+          fin.seek(-csc_packet.itemsize, 2)
+          last = pylab.fromfile(fin, dtype=csc_packet, count=1)[0]
+        t0 = int(last['timestamp']) + int(round(last['Ns'] * 1e6 / Fs))
+    self.t_segment = t0 #Start time (us) of the current contiguous segment
+    self.n_segment = 0 #Samples written in the current segment
+    self.pending = pylab.zeros(0, dtype='h')
+
+  def append(self, samples, t=None):
+    """
+    Inputs:
+      samples - array of samples (A/D units). Non integer samples (e.g. filtered data) are rounded and values outside
+                the int16 range are clipped
+      t - if not None, the time (us) of the first sample. This starts a new segment (e.g. after a pause in the
+          recording). Otherwise the samples are taken to follow on from the previous block
+    """
+    if t is not None:
+      self.flush()
+      self.t_segment = t
+      self.n_segment = 0
+    samples = pylab.asarray(samples)
+    if samples.dtype != pylab.int16:
+      samples = pylab.clip(pylab.round_(samples), -32768, 32767).astype('h')
+    samples = pylab.concatenate((self.pending, samples))
+    n_full = samples.size / 512
+    self.write_packets(samples[:n_full*512], n_full)
+    self.pending = samples[n_full*512:]
+
+  def flush(self):
+    """Write out any held back samples as a partially filled packet."""
+    if self.pending.size:
+      self.write_packets(self.pending, 1)
+      self.pending = pylab.zeros(0, dtype='h')
+
+  def write_packets(self, samples, n_packets):
+    records = pylab.zeros(n_packets, dtype=csc_packet)
+    first_sample = self.n_segment + 512*pylab.arange(n_packets)
+    records['timestamp'] = self.t_segment + pylab.around(first_sample * 1e6 / self.Fs).astype('Q')
+    records['chan'] = self.chan
+    records['Fs'] = int(round(self.Fs))
+    records['Ns'] = 512
+    n_samples = samples.size
+    if n_samples % 512: #Partially filled last packet
+      records['Ns'][-1] = n_samples % 512
+      samples = pylab.concatenate((samples, pylab.zeros(n_packets*512 - n_samples, dtype='h')))
+    records['samp'] = samples.reshape(n_packets, 512)
+    self.write_records(records)
+    self.n_segment += n_samples
+
+  def close(self):
+    if not self.fout.closed:
+      self.flush()
+    NeuralynxWriter.close(self)
+
+
+def write_nse(fname, timestamps, waveforms=None, features=None, cellno=1, remarks=''):
+  """Write spikes to a new .nse file in one go. See NSEWriter.append for the inputs."""
+  with NSEWriter(fname, remarks=remarks) as w:
+    w.append(timestamps, waveforms=waveforms, features=features, cellno=cellno)
+
+def write_nev(fname, timestamps, ttl, eventid=0, eventstring=None, remarks=''):
+  """Write events to a new .nev file in one go. See NEVWriter.append for the inputs."""
+  with NEVWriter(fname, remarks=remarks) as w:
+    w.append(timestamps, ttl, eventid=eventid, eventstring=eventstring)
+
+def write_ncs(fname, samples, Fs, t0=0, chan=0, remarks=''):
+  """Write a trace to a new .ncs file in one go. See NCSWriter for the inputs."""
+  with NCSWriter(fname, Fs, t0=t0, chan=chan, remarks=remarks) as w:
+    w.append(samples)
@@ -3,35 +3,59 @@ This script does a quick check of the extraction by comparing the data in the TT
 Tp be able to run this you should be saving the Events.nev file while recording the data.
 """
 
-import os, argparse, logging
+import os, argparse, logging, pylab
 logger = logging.getLogger(__name__)
 from neurapy.neuralynx import lynxio
 
-def check_codes(codes, times, codes_raw, times_raw):
-  """Cycle through each event in turn (ignore events with code 0 - those are recording start and do not match in the
-  raw file), find the raw code that corresponds to the matching time and see if the code matches. Flag the file if
-  any code does not match up and spit out the first index and time stamp where things don't match. Return True if no
-  errors with the file, False otherwise"""
+def verify_codes(codes, times, codes_raw, times_raw):
+  """Match every event (ignoring events with code 0 - those are recording start and do not match in the raw file) to
+  the raw timestamp stream with a single searchsorted and compare the lower 8 bits of the codes.
+  Inputs:
+    codes, times - TTL words and timestamps from the Events.nev file
+    codes_raw, times_raw - TTL words and timestamps extracted from the .nrd file (may be memmaps)
+  Output:
+    Dictionary with fields
+      'checked'  - number of events checked
+      'missing'  - indexes (into codes/times) of events whose time stamp is not found in the raw stream
+      'mismatch' - indexes of events whose times match up but whose codes do not
+      'time'     - time stamps of the mismatched events
+      'expected' - codes from the Events.nev file for the mismatched events
+      'actual'   - codes from the raw file for the mismatched events
+  """
+  times = pylab.asarray(times, dtype='uint64')
+  codes = pylab.asarray(codes)
+  idx = pylab.flatnonzero(codes != 0)
+  t = times[idx]
+  if times_raw.size:
+    cri = pylab.searchsorted(times_raw, t).clip(max=times_raw.size - 1)
+    found = times_raw[cri] == t
+  else:
+    cri = pylab.zeros(t.size, dtype=int)
+    found = pylab.zeros(t.size, dtype=bool)
 
-  cri = 0
-  for n, (code, time) in enumerate(zip(codes, times)):
-    time = int(time)
-    if code == 0: continue
-    while times_raw[cri] != time:
-      #cri += int((time - int(times_raw[cri]))/30.8 + .5)
-      fwd = (time - int(times_raw[cri])) >> 5
-      if fwd == 0: fwd = 1
-      cri += fwd
-      if cri >= times_raw.size:
-        logger.error('Problem with matching code times for code #{:d}: Ran out of raw data'.format(n))
-        return False
+  fidx = idx[found]
+  expected = codes[fidx]
+  actual = pylab.asarray(codes_raw[cri[found]])
+  bad = ((expected.astype('uint32') ^ actual.astype('uint32')) & 0xff) != 0 #Are the lower 8 bits the same?
 
-    #If we get here we successfully matched up times
-    if (code ^ codes_raw[cri]) & 0xff: #More compact way of testing if the lower 8 bits of the two are same
-      logger.error('Times matchup, but codes do not for code #{:d}'.format(n))
-      return False
+  return {
+    'checked': idx.size,
+    'missing': idx[~found],
+    'mismatch': fidx[bad],
+    'time': times[fidx[bad]],
+    'expected': expected[bad],
+    'actual': actual[bad]
+  }
 
-  return True #If we get here, all is OK
+def check_codes(codes, times, codes_raw, times_raw):
+  """Run verify_codes and log the problems. Return True if no errors with the file, False otherwise"""
+  report = verify_codes(codes, times, codes_raw, times_raw)
+  for n in report['missing']:
+    logger.error('Problem with matching code times for code #{:d}: time {:d} not in raw data'.format(int(n), int(times[n])))
+  for n, t, ex, ac in zip(report['mismatch'], report['time'], report['expected'], report['actual']):
+    logger.error('Times matchup, but codes do not for code #{:d} (time {:d}, expected {:d}, got {:d})'.format(int(n), int(t), int(ex), int(ac)))
+  logger.info('{:d} codes checked, {:d} missing, {:d} mismatched'.format(report['checked'], report['missing'].size, report['mismatch'].size))
+  return report['missing'].size + report['mismatch'].size == 0
 
 def process_session(events_nev_fname='Events.nev', timestamps_raw_fname='timestamps.raw', ttl_raw_fname='ttl.raw'):
   """Wrapper around check_codes."""
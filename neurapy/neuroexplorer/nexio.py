@@ -1,19 +1,24 @@
-"""Module contains methods to read .nex files produced from the offline sorter.
+"""Module contains methods to read .nex files produced from the offline sorter, and to write .nex files (e.g. of
+sorted units and events) that can be opened in NeuroExplorer.
 Based on documents from http://www.neuroexplorer.com/code.html. The text file
 HowToReadAndWriteNexFilesInCPlusPlus.txt is especially useful
 """
 
-import struct, pylab, logging
+import struct, pylab, logging, tempfile, shutil
+from collections import OrderedDict
 logger = logging.getLogger(__name__)
 
 upk = struct.unpack
 sz = struct.calcsize
 rd = lambda f,fmt: upk(fmt, f.read(sz(fmt))) #My first lambda, you'll thank me later
 
+def read_timestamps(f, dt, v):
+  """Read the v['N'] time stamps at the current position and convert them to seconds."""
+  return pylab.fromfile(f, dtype='i', count=v['N'])/dt['Header']['Freq']
+
 def a_neuron(f, dt, v):
   """Read a neuron from the stream."""
-  fmt = str(v['N']) + 'i'
-  time_stamps = pylab.array(rd(f,fmt))/dt['Header']['Freq']
+  time_stamps = read_timestamps(f, dt, v)
   this_neuron = {
     'name': v['name'],
     'version': v['version'],
@@ -29,8 +34,7 @@ def a_neuron(f, dt, v):
 
 def an_event(f, dt, v):
   """Read an event type from the stream."""
-  fmt = str(v['N']) + 'i'
-  time_stamps = pylab.array(rd(f,fmt))/dt['Header']['Freq']
+  time_stamps = read_timestamps(f, dt, v)
   this_event = {
     'name': v['name'],
     'version': v['version'],
@@ -47,11 +51,10 @@ def an_interval(f, dt, vars):
 
 def a_waveform(f, dt, v):
   """Read a waveform set from the stream."""
-  fmt = str(v['N']) + 'i'
-  time_stamps = pylab.array(rd(f,fmt))/dt['Header']['Freq']
+  time_stamps = read_timestamps(f, dt, v)
 
-  fmt = str(v['N']*v['npW']) + 'h'
-  waveforms = pylab.array(rd(f,fmt)).reshape((v['N'], v['npW'])) * v['AD2mV']
+  waveforms = pylab.fromfile(f, dtype='h', count=v['N']*v['npW']).reshape((v['N'], v['npW'])).astype(float)
+  waveforms *= v['AD2mV']
 
   this_waveform = {
     'name': v['name'],
@@ -68,23 +71,14 @@ def a_pop_vector(f, dt, vars):
   return dt
 
 def cont_var(f, dt, v):
-  """Read a continuous variable from the stream."""
-  fmt = str(v['N']) + 'i'
-  time_stamps = pylab.array(rd(f,fmt))/dt['Header']['Freq']
-
-  fmt = str(v['N']) + 'i'
-  indexes = pylab.array(rd(f,fmt))
-
-  fmt = str(v['npW']) + 'h'
-  waveform = pylab.array(rd(f,fmt)) * v['AD2mV']
+  """Read a continuous variable from the stream. The fragments in 'waveform' are views into a single array of all
+  the samples ('samples')"""
+  time_stamps = read_timestamps(f, dt, v)
+  indexes = pylab.fromfile(f, dtype='i', count=v['N'])
 
-  waveforms = []
-  st = indexes[0]
-  for n in xrange(1,indexes.size):
-    nd = indexes[n]
-    waveforms.append(pylab.array(waveform[st:nd]))
-    st = indexes[n]
-  waveforms.append(pylab.array(waveform[st:]))
+  samples = pylab.fromfile(f, dtype='h', count=v['npW']).astype(float)
+  samples *= v['AD2mV']
+  waveforms = pylab.split(samples, indexes[1:]) #Views, not copies
 
   this_continuous = {
     'name': v['name'],
@@ -92,6 +86,7 @@ def cont_var(f, dt, v):
     'timestamps': time_stamps,
     'indexes': indexes,
     'sampling freq': v['wSampF'],
+    'samples': samples,
     'waveform': waveforms
   }
   dt['Continuous'].append(this_continuous)
@@ -99,8 +94,7 @@ def cont_var(f, dt, v):
 
 def a_marker(f, dt, v):
   """Read a set of markers (which are what we dump from our experiment control software) from the stream."""
-  fmt = str(v['N']) + 'i'
-  time_stamps = pylab.array(rd(f,fmt))/dt['Header']['Freq']
+  time_stamps = read_timestamps(f, dt, v)
   this_marker = {
     'name': v['name'],
     'version': v['version'],
@@ -109,19 +103,81 @@ def a_marker(f, dt, v):
   # Each time stamp can have several fields each with an associated value
   # The neuroexplorer system only dumps one field whose value is the strobed word stored as a string
 
+  # The values of a field are stored as one block of N fixed width, null padded strings, which we read in one go
+  # into a string array (this drops the trailing nulls)
+
   for n in range(v['Nmarkers']):
     mk_name = f.read(64).strip('\x00')
     if mk_name in ['name', 'version', 'timestamps']:#Try to avoid a name clash (it is possible)
       mk_name = 'my' + mk_name
-    val = [f.read(v['markerLen']).strip('\x00') for m in range(v['N'])]
+    val = pylab.char.strip(pylab.fromfile(f, dtype='S{:d}'.format(v['markerLen']), count=v['N']))
     if v['name'] == 'Strobed':
       logger.debug('Marker name is Strobed, treating it as Plexon strobed word and converting it to a numerical array')
-      val = pylab.array([int(va) for va in val])
+      val = val.astype(int)
     this_marker[mk_name] = val
 
   dt['Markers'].append(this_marker)
   return dt
 
+#Type codes used in the variable headers
+data_type = {
+  'neurons': 0,
+  'events': 1,
+  'intervals': 2,
+  'waveforms': 3,
+  'popvectors': 4,
+  'continuous': 5,
+  'markers': 6
+}
+
+#Python switch statement made as a dictionary. Will lead to keyValueError if we get something out of scope
+switch = {
+  0: a_neuron,
+  1: an_event,
+  2: an_interval,
+  3: a_waveform,
+  4: a_pop_vector,
+  5: cont_var,
+  6: a_marker
+}
+
+#Where each type ends up in the dictionary returned by read_nex
+type_key = {
+  0: 'Neurons',
+  1: 'Events',
+  2: 'Intervals',
+  3: 'Waveforms',
+  4: 'Population vectors',
+  5: 'Continuous',
+  6: 'Markers'
+}
+
+def read_file_header(f):
+  """Read the file header. Returns the header dictionary and the number of variables in the file."""
+  h = {}
+  ftid = f.read(4)
+  if ftid != 'NEX1':
+    logger.error('Not a .nex file : ' + f.name)
+  else:
+    logger.debug('Reading ' + f.name)
+
+  fmt = '=i 256s d i i i 260s' # '=' means don't align
+  h['Version'], h['Comment'], h['Freq'], h['t begin'], h['t end'], nvar, dummy,  = rd(f,fmt)
+  h['Comment'] = h['Comment'].strip('\x00')
+  h['t begin'] = h['t begin']/h['Freq']
+  h['t end'] = h['t end']/h['Freq']
+  return h, nvar
+
+def read_var_header(f):
+  """Read the next variable header. Returns the variable dictionary, which includes the 'type' and the 'offset' of the
+  variable's data in the file."""
+  fmt = '=i i 64s i i i i i i d d d d i i i d 60s'
+  v = {}
+  v['type'], v['version'], name, v['offset'], v['N'], v['wireNo'], v['unitNo'], v['gain'], v['filter'], \
+  v['xPos'], v['yPos'], v['wSampF'], v['AD2mV'], v['npW'], v['Nmarkers'], v['markerLen'], v['mVoffset'], dummy = rd(f,fmt)
+  v['name'] = name.strip('\x00')
+  return v
+
 def read_nex(fname = '../../Data/SortedNex/Space vs Object Learning-Flippe-07-22-2009-KG.nex',
              load = ['neurons', 'events', 'intervals', 'waveforms', 'popvectors', 'continuous', 'markers']):
   """Reads nex file into a standard python dictionary.
@@ -135,43 +191,12 @@ def read_nex(fname = '../../Data/SortedNex/Space vs Object Learning-Flippe-07-22
          'popvectors' - don't know what this is
          'continuous' - any continuous channels recorded
          'markers' - markers
+  To load individual variables by name, see NexFile
   """
-  data_type = {
-    'neurons': 0,
-    'events': 1,
-    'intervals': 2,
-    'waveforms': 3,
-    'popvectors': 4,
-    'continuous': 5,
-    'markers': 6
-  }
   types_to_load = [data_type[dt] for dt in load]
 
-  #Python switch statement made as a dictionary. Will lead to keyValueError if we get something out of scope
-  switch = {
-    0: a_neuron,
-    1: an_event,
-    2: an_interval,
-    3: a_waveform,
-    4: a_pop_vector,
-    5: cont_var,
-    6: a_marker
-  }
-
-  f = open(fname, 'r')
-
-  h = {}
-  ftid = f.read(4)
-  if ftid != 'NEX1':
-    logger.error('Not a .nex file : ' + fname)
-  else:
-    logger.debug('Reading ' + fname)
-
-  fmt = '=i 256s d i i i 260s' # '=' means don't align
-  h['Version'], h['Comment'], h['Freq'], h['t begin'], h['t end'], nvar, dummy,  = rd(f,fmt)
-  h['Comment'] = h['Comment'].strip('\x00')
-  h['t begin'] = h['t begin']/h['Freq']
-  h['t end'] = h['t end']/h['Freq']
+  f = open(fname, 'rb')
+  h, nvar = read_file_header(f)
 
   dt = {
     'Header': h,
@@ -185,20 +210,290 @@ def read_nex(fname = '../../Data/SortedNex/Space vs Object Learning-Flippe-07-22
   }
 
   for k in range(nvar):
-    fmt = '=i i 64s i i i i i i d d d d i i i d 60s'
-    v = {}
-    type, v['version'], name, offset, v['N'], v['wireNo'], v['unitNo'], v['gain'], v['filter'], \
-    v['xPos'], v['yPos'], v['wSampF'], v['AD2mV'], v['npW'], v['Nmarkers'], v['markerLen'], v['mVoffset'], dummy = rd(f,fmt)
-    v['name'] = name.strip('\x00')
-
-    if type in types_to_load:
+    v = read_var_header(f)
+    if v['type'] in types_to_load:
       this_place = f.tell()
-      f.seek(offset)
-      dt = switch[type](f, dt, v)
+      f.seek(v['offset'])
+      dt = switch[v['type']](f, dt, v)
       f.seek(this_place)
 
   f.close()
   return dt
 
+
+class NexFile:
+  """Lazy access to the variables in a .nex file. Only the file header and the variable headers are read when the
+  object is created. They are kept in a directory (self.directory: a list of the variable headers with 'name', 'type',
+  'N', 'offset' etc.). Individual variables are loaded by name only when they are asked for, and the most recently
+  used ones are kept in a cache.
+
+  e.g.
+    from neurapy.neuroexplorer import nexio
+    nex = nexio.NexFile('seqdms-jeff-07-21-2012.nex')
+    nex.names('neurons')      -> names of all the neurons in the file
+    sig001a = nex['sig001a']  -> same dictionary as the entries in read_nex()['Neurons']
+    nex.close()
+
+  Inputs:
+    fname - name of nex file
+    cache_size - how many variables to keep in the cache
+  """
+  def __init__(self, fname, cache_size=16):
+    self.fname = fname
+    self.cache_size = cache_size
+    self.cache = OrderedDict()
+    self.f = open(fname, 'rb')
+    self.header, nvar = read_file_header(self.f)
+    self.directory = [read_var_header(self.f) for k in range(nvar)]
+    self.by_name = {}
+    for v in self.directory:
+      if v['name'] in self.by_name:
+        logger.warning('Duplicate variable name ' + v['name'] + '. Only the first one is accessible by name')
+      else:
+        self.by_name[v['name']] = v
+
+  def names(self, type=None):
+    """Names of the variables in the file, in file order. type is one of the strings read_nex accepts in 'load' and
+    restricts the list to that type of variable."""
+    return [v['name'] for v in self.directory if type is None or v['type'] == data_type[type]]
+
+  def __contains__(self, name):
+    return name in self.by_name
+
+  def __getitem__(self, name):
+    """Load the variable with this name (or pull it from the cache)."""
+    if name in self.cache:
+      var = self.cache.pop(name)
+    else:
+      var = self.load(self.by_name[name])
+    self.cache[name] = var #Most recently used goes to the end
+    while len(self.cache) > self.cache_size:
+      self.cache.popitem(last=False)
+    return var
+
+  def load(self, v):
+    """Read the variable described by the variable header v. Returns None for types we do not load (intervals and
+    population vectors)."""
+    key = type_key[v['type']]
+    dt = {'Header': self.header, key: []}
+    self.f.seek(v['offset'])
+    switch[v['type']](self.f, dt, v)
+    return dt[key][0] if dt[key] else None
+
+  def close(self):
+    self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+class NexWriter:
+  """Write a .nex file. Variables are added with the add_* methods, passing times in seconds and values in the same
+  units that read_nex returns. Nothing is written until close(): at that point the offsets of all the variables are
+  computed and each data block goes out with one tofile call.
+
+  Continuous variables can be streamed: declare them with add_continuous and feed blocks of samples with
+  append_continuous. The samples are converted to A/D units and spilled to a temporary file as they come in (they have
+  to come after the fragment time stamps and indexes in the .nex file) and copied into place on close.
+
+  e.g.
+    from neurapy.neuroexplorer import nexio
+    with nexio.NexWriter('sorted.nex', freq=40000.0) as nw:
+      nw.add_neuron('sig001a', ts)
+      nw.add_event('Start', start_times)
+      nw.add_marker('Strobed', strobe_times, {'DIO': strobe_words})
+      nw.add_continuous('AD01', fs=1000.0, ad2mv=0.005)
+      for block in blocks:
+        nw.append_continuous('AD01', block)
+  """
+  def __init__(self, fname, freq=40000.0, comment=''):
+    self.fname = fname
+    self.freq = float(freq)
+    self.comment = comment
+    self.variables = [] #(variable header, data blocks) in the order they will appear in the file
+    self.continuous = {}
+    self.t_begin = None
+    self.t_end = None
+
+  def ticks(self, t):
+    """Convert times in seconds to (int32) timestamp ticks and keep track of the time span of the file."""
+    t = pylab.around(pylab.asarray(t, dtype=float) * self.freq).astype('i')
+    if t.size:
+      self.t_begin = t.min() if self.t_begin is None else min(self.t_begin, t.min())
+      self.t_end = t.max() if self.t_end is None else max(self.t_end, t.max())
+    return t
+
+  def add_variable(self, type, name, N, blocks, **kwargs):
+    v = {'type': type, 'version': 100, 'name': name, 'N': N, 'wireNo': 0, 'unitNo': 0, 'gain': 0, 'filter': 0,
+         'xPos': 0.0, 'yPos': 0.0, 'wSampF': 0.0, 'AD2mV': 0.0, 'npW': 0, 'Nmarkers': 0, 'markerLen': 0, 'mVoffset': 0.0}
+    v.update(kwargs)
+    self.variables.append((v, blocks))
+    return v
+
+  def add_neuron(self, name, timestamps, wire_no=0, unit_no=0, x_pos=0.0, y_pos=0.0):
+    ts = self.ticks(timestamps)
+    self.add_variable(0, name, ts.size, [ts], wireNo=wire_no, unitNo=unit_no, xPos=x_pos, yPos=y_pos)
+
+  def add_event(self, name, timestamps):
+    ts = self.ticks(timestamps)
+    self.add_variable(1, name, ts.size, [ts])
+
+  def add_waveform(self, name, timestamps, waveforms, fs, ad2mv=None, wire_no=0, unit_no=0):
+    """waveforms - N x npW array of waveforms (mV). If ad2mv is None it is chosen to use the full int16 range."""
+    ts = self.ticks(timestamps)
+    waveforms = pylab.atleast_2d(pylab.asarray(waveforms, dtype=float))
+    if ad2mv is None:
+      ad2mv = ad_scale(waveforms)
+    raw = to_ad(waveforms, ad2mv)
+    self.add_variable(3, name, ts.size, [ts, raw], wireNo=wire_no, unitNo=unit_no, wSampF=fs, AD2mV=ad2mv,
+                      npW=raw.shape[1])
+
+  def add_marker(self, name, timestamps, fields):
+    """fields - dictionary (or list of (name, values) pairs) of marker fields. Each field has one value per timestamp.
+    Values are stored as strings."""
+    ts = self.ticks(timestamps)
+    if hasattr(fields, 'items'):
+      fields = fields.items()
+    names = [fn for fn, val in fields]
+    values = [pylab.asarray(val).astype('S') for fn, val in fields]
+    marker_len = max([pylab.char.str_len(val).max() for val in values if val.size] + [0]) + 1 #Room for the null
+    blocks = [ts]
+    for fn, val in zip(names, values):
+      blocks.append(pylab.array(fn, dtype='S64'))
+      blocks.append(val.astype('S{:d}'.format(marker_len)))
+    self.add_variable(6, name, ts.size, blocks, Nmarkers=len(names), markerLen=marker_len)
+
+  def add_continuous(self, name, fs, ad2mv=None, samples=None, t0=0.0):
+    """Declare a continuous variable. If samples (mV) are given they are added as the first fragment, starting at t0.
+    For streamed data ad2mv has to be given up front. If it is None it is chosen from the samples passed here."""
+    if ad2mv is None:
+      if samples is None:
+        raise ValueError('Need ad2mv, or the samples to work it out from')
+      ad2mv = ad_scale(samples)
+    v = self.add_variable(5, name, 0, None, wSampF=fs, AD2mV=ad2mv)
+    self.continuous[name] = {
+      'v': v,
+      'position': len(self.variables) - 1,
+      'spill': tempfile.TemporaryFile(),
+      'timestamps': [],
+      'indexes': []
+    }
+    if samples is not None:
+      self.append_continuous(name, samples, t=t0)
+
+  def append_continuous(self, name, samples, t=None):
+    """Append samples (mV) to a continuous variable. If t (s) is given, these samples start a new fragment at time t.
+    Otherwise they carry on from the end of the last block."""
+    cv = self.continuous[name]
+    v = cv['v']
+    if t is None and not cv['timestamps']:
+      t = 0.0
+    if t is not None:
+      cv['timestamps'].append(t)
+      cv['indexes'].append(v['npW'])
+    raw = to_ad(samples, v['AD2mV'])
+    raw.tofile(cv['spill'])
+    v['npW'] += raw.size
+
+  def close(self):
+    """Work out the offsets and write the file. The spill files are deleted even if writing fails."""
+    try:
+      self.write()
+    finally:
+      self.discard()
+
+  def write(self):
+    for cv in self.continuous.values():
+      v = cv['v']
+      t_last = 0.0
+      if cv['timestamps']:
+        t_last = cv['timestamps'][-1] + (v['npW'] - cv['indexes'][-1]) / float(v['wSampF'])
+      ts = self.ticks(cv['timestamps'])
+      self.ticks([t_last]) #So the file time span covers the end of the data
+      v['N'] = ts.size
+      cv['spill'].seek(0)
+      self.variables[cv['position']] = (v, [ts, pylab.array(cv['indexes'], dtype='i'), cv['spill']])
+
+    hdr_fmt = '=4s i 256s d i i i 260s'
+    var_fmt = '=i i 64s i i i i i i d d d d i i i d 60s'
+    offset = struct.calcsize(hdr_fmt) + len(self.variables) * struct.calcsize(var_fmt)
+    for v, blocks in self.variables:
+      v['offset'] = offset
+      offset += data_bytes(v)
+
+    with open(self.fname, 'wb') as fout:
+      fout.write(struct.pack(hdr_fmt, 'NEX1', 104, self.comment, self.freq, self.t_begin or 0, self.t_end or 0,
+                             len(self.variables), ''))
+      for v, blocks in self.variables:
+        fout.write(struct.pack(var_fmt, v['type'], v['version'], v['name'], v['offset'], v['N'], v['wireNo'],
+                               v['unitNo'], v['gain'], v['filter'], v['xPos'], v['yPos'], v['wSampF'], v['AD2mV'],
+                               v['npW'], v['Nmarkers'], v['markerLen'], v['mVoffset'], ''))
+      for v, blocks in self.variables:
+        for b in blocks:
+          if isinstance(b, pylab.ndarray):
+            b.tofile(fout)
+          else: #Spilled continuous samples
+            shutil.copyfileobj(b, fout, 16*1024*1024)
+
+  def discard(self):
+    """Close (and so delete) the spill files and forget the variables, without writing anything."""
+    for cv in self.continuous.values():
+      cv['spill'].close()
+    self.variables = []
+    self.continuous = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.discard()
+
+
+def ad_scale(x):
+  """AD2mV that maps the largest magnitude in x to the top of the int16 range."""
+  m = pylab.absolute(x).max() if pylab.size(x) else 0
+  return m / 32767.0 if m > 0 else 1.0
+
+def to_ad(x, ad2mv):
+  """Convert mV to int16 A/D units."""
+  return pylab.around(pylab.asarray(x, dtype=float) / ad2mv).clip(-32768, 32767).astype('h')
+
+def data_bytes(v):
+  """Size of the data block of the variable described by the variable header v."""
+  N = v['N']
+  if v['type'] == 3:
+    return 4*N + 2*N*v['npW']
+  elif v['type'] == 5:
+    return 8*N + 2*v['npW']
+  elif v['type'] == 6:
+    return 4*N + v['Nmarkers']*(64 + N*v['markerLen'])
+  else:
+    return 4*N
+
+def write_nex(fname, dt):
+  """Write out a dictionary in the format that read_nex returns (neurons, events, waveforms, continuous variables and
+  markers) as a .nex file."""
+  h = dt.get('Header', {})
+  with NexWriter(fname, freq=h.get('Freq', 40000.0), comment=h.get('Comment', '')) as nw:
+    for n in dt.get('Neurons', []):
+      nw.add_neuron(n['name'], n['timestamps'], wire_no=n.get('wire no', 0), unit_no=n.get('unit no', 0),
+                    x_pos=n.get('x pos', 0.0), y_pos=n.get('y pos', 0.0))
+    for e in dt.get('Events', []):
+      nw.add_event(e['name'], e['timestamps'])
+    for w in dt.get('Waveforms', []):
+      nw.add_waveform(w['name'], w['timestamps'], w['waveforms'], w['sampling freq'])
+    for c in dt.get('Continuous', []):
+      nw.add_continuous(c['name'], c['sampling freq'], ad2mv=ad_scale(pylab.concatenate(c['waveform'])))
+      for t, wf in zip(c['timestamps'], c['waveform']):
+        nw.append_continuous(c['name'], wf, t=t)
+    for m in dt.get('Markers', []):
+      fields = [(k, val) for k, val in m.items() if k not in ['name', 'version', 'timestamps']]
+      nw.add_marker(m['name'], m['timestamps'], fields)
+
 if __name__ == "__main__":
   dt = read_nex() #Do a test run
\ No newline at end of file
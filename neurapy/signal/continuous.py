@@ -1,8 +1,9 @@
 """Some methods for dealing with continuous data. We assume that the original data is in files and that they are
 annoyingly large. So all the methods here work on buffered input, using memory maps.
 """
-import pylab
-from scipy.signal import filtfilt, iirdesign
+import logging, os, pylab
+from scipy.signal import filtfilt, firwin, iirdesign, lfilter, sosfilt, sosfilt_zi, sosfiltfilt, upfirdn
+logger = logging.getLogger(__name__)
 
 #Some useful presets for loading continuous data dumped from the Neuralynx system
 lynxlfp = {
@@ -13,7 +14,7 @@ lynxlfp = {
   'gpass' : 0.1,
   'gstop' : 15,
   'buffer_len' : 100000,
-  'overlap_len': 100,
+  'overlap_len': None,
   'max_len': -1
 }
 
@@ -25,26 +26,65 @@ lynxspike = {
   'gpass' : 0.1,
   'gstop' : 15,
   'buffer_len' : 100000,
-  'overlap_len': 100,
+  'overlap_len': None,
   'max_len': -1
 }
 """Use these presets as follows
 
-from neurapy.utility import continuous as cc
-y,b,a = cc.butterfilt('chan_000.raw', 'test.raw', **cc.lynxlfp)"""
+from neurapy.signal import continuous as cc
+y,sos = cc.butterfilt('chan_000.raw', 'test.raw', **cc.lynxlfp)
 
+overlap_len None works out the overlap from the impulse response of the filter (see impulse_len)
 
-def butterfilt(finname, foutname, fmt, fs, fl=5.0, fh=100.0, gpass=1.0, gstop=30.0, ftype='butter', buffer_len=100000, overlap_len=100, max_len=-1):
-  """Given sampling frequency, low and high pass frequencies design a butterworth filter and filter our data with it."""
-  fso2 = fs/2.0
-  wp = [fl/fso2, fh/fso2]
-  ws = [0.8*fl/fso2,1.4*fh/fso2]
-  import pdb; pdb.set_trace()
-  b, a = iirdesign(wp, ws, gpass=gpass, gstop=gstop, ftype=ftype, output='ba')
-  y = filtfiltlong(finname, foutname, fmt, b, a, buffer_len, overlap_len, max_len)
-  return y, b, a
+Multichannel files (samples x channels, channel interleaved) are filtered all channels at a time, e.g. a Cerebus .NSx
+file
+
+from neurapy.cerebus import nsx
+h, x = nsx.memmap_data('data.ns5')
+sos = cc.design_sos(h['Fs Hz'], 500, 7500, 0.1, 15)
+y = cc.sosfiltfiltlong('data.ns5', 'data-spike.raw', 'h', sos, n_channels=h['number of channels'],
+                       offset=h['bytes in header'], processes=4)
+or, for an array already in hand
+y = cc.filtfiltarray(x, pylab.memmap('data-spike.raw', dtype='h', mode='w+', shape=x.shape), sos)
 
-def filtfiltlong(finname, foutname, fmt, b, a, buffer_len=100000, overlap_len=100, max_len=-1):
+The LFP band does not need to be kept at the raw sampling rate. Decimate it after filtering
+
+y,sos = cc.butterfilt('chan_000.raw', 'lfp.raw', **cc.lynxlfp)
+z = cc.decimatelong('lfp.raw', 'lfp-1k.raw', 'i', 32) -> sampled at 32556/32 Hz"""
+
+
+def butterfilt(finname, foutname, fmt, fs, fl=5.0, fh=100.0, gpass=1.0, gstop=30.0, ftype='butter', buffer_len=100000, overlap_len=None, max_len=-1, processes=1, n_channels=1, offset=0):
+  """Given sampling frequency, low and high pass frequencies design a butterworth filter and filter our data with it.
+  The filter is designed as second order sections (see design_sos) and run with sosfiltfiltlong.
+  Outputs:
+    y   - the memmapped filtered data
+    sos - the filter"""
+  sos = design_sos(fs, fl, fh, gpass, gstop, ftype)
+  y = sosfiltfiltlong(finname, foutname, fmt, sos, buffer_len, overlap_len, max_len, processes, n_channels, offset)
+  return y, sos
+
+def impulse_len(coeffs, tol=1e-4, max_n=2**22):
+  """Number of samples it takes the impulse response of a filter to decay below tol times its peak. This is how far
+  the transient from a chunk edge reaches into the chunk, so it is the overlap we need when filtering in chunks.
+  Inputs:
+    coeffs - sos array or (b, a) tuple
+    tol    - relative size of the tail we can ignore
+    max_n  - give up looking beyond this many samples
+  """
+  n = 1024
+  while True:
+    x = pylab.zeros(n)
+    x[0] = 1
+    if isinstance(coeffs, tuple):
+      h = abs(lfilter(coeffs[0], coeffs[1], x))
+    else:
+      h = abs(sosfilt(coeffs, x))
+    last = pylab.flatnonzero(h > tol * h.max())[-1]
+    if last < n/2 or n >= max_n:
+      return int(last) + 1
+    n *= 2
+
+def filtfiltlong(finname, foutname, fmt, b, a, buffer_len=100000, overlap_len=100, max_len=-1, processes=1, n_channels=1, offset=0):
   """Use memmap and chunking to filter continuous data.
   Inputs:
     finname -
@@ -52,10 +92,19 @@ def filtfiltlong(finname, foutname, fmt, b, a, buffer_len=100000, overlap_len=10
     fmt         - data format eg 'i'
     b,a         - filter coefficients
     buffer_len  - how much data to process at a time
-    overlap_len - how much data do we add to the end of each chunk to smooth out filter transients
+    overlap_len - how much data do we add to the end of each chunk to smooth out filter transients. None works it out
+                  from the impulse response of the filter (see impulse_len)
     max_len     - how many samples to process. If set to -1, processes the whole file
+    processes   - number of processes to filter the chunks in. None uses all the cores. Each process opens its own
+                  memmaps of the input and output files and writes its chunks directly into the output file, so the
+                  result is identical to filtering in this process (processes=1)
+    n_channels  - number of channels in a channel interleaved file. The data is then a (samples x channels) array and
+                  all the channels of a chunk are filtered in one call. max_len counts samples per channel
+    offset      - bytes of header to skip at the start of the input file (e.g. 'bytes in header' of an .NSx file).
+                  The output file has no header
   Outputs:
-    y           - The memmapped array pointing to the written file
+    y           - The memmapped array pointing to the written file. 1-D if n_channels is 1, (samples x channels)
+                  otherwise
 
 
   Notes on algorithm:
@@ -74,18 +123,254 @@ def filtfiltlong(finname, foutname, fmt, b, a, buffer_len=100000, overlap_len=10
     each buffer boundary.
 
   """
-  x = pylab.memmap(finname, dtype=fmt, mode='r')
-  if max_len == -1:
-    max_len = x.size
-  y = pylab.memmap(foutname, dtype=fmt, mode='w+', shape=max_len)
+  return zero_phase_long(finname, foutname, fmt, (b, a), buffer_len, overlap_len, max_len, processes, n_channels,
+                         offset)
 
-  for buff_st_idx in xrange(0, max_len, buffer_len):
+def sosfiltfiltlong(finname, foutname, fmt, sos, buffer_len=100000, overlap_len=None, max_len=-1, processes=1, n_channels=1, offset=0):
+  """Like filtfiltlong, but for a filter given as second order sections (e.g. from design_sos), which stays accurate
+  for the high order bandpass filters we use on the raw data where the b, a form does not.
+  Inputs:
+    sos         - the filter
+    overlap_len - None works out the overlap from the impulse response of the filter
+  See filtfiltlong for the rest"""
+  return zero_phase_long(finname, foutname, fmt, sos, buffer_len, overlap_len, max_len, processes, n_channels, offset)
+
+def memmap_channels(fname, fmt, n_channels=1, offset=0, mode='r', n_samples=None):
+  """Memory map a raw data file as a 1-D array (n_channels = 1) or a (samples x channels) array of channel interleaved
+  data, skipping offset bytes of header. n_samples defaults to as many whole samples as there are in the file."""
+  if n_samples is None:
+    n_samples = (os.path.getsize(fname) - offset) // (pylab.dtype(fmt).itemsize * n_channels)
+  shape = n_samples if n_channels == 1 else (n_samples, n_channels)
+  return pylab.memmap(fname, dtype=fmt, mode=mode, offset=offset, shape=shape)
+
+def filtfiltarray(x, y, coeffs, buffer_len=100000, overlap_len=None, buffer_starts=None):
+  """Zero phase filter x into y, chunk by chunk along axis 0, as filtfiltlong does. x and y are arrays (typically
+  memmaps) that are 1-D or (samples x channels): all the channels of a chunk are filtered in one call.
+  Inputs:
+    x             - input data
+    y             - output array, with as many samples as we should filter
+    coeffs        - (b, a) tuple or sos array
+    buffer_starts - filter only the buffers starting at these samples. None does all of y
+  Outputs:
+    y"""
+  if overlap_len is None:
+    overlap_len = impulse_len(coeffs)
+  max_len = y.shape[0]
+  if buffer_starts is None:
+    buffer_starts = range(0, max_len, buffer_len)
+  for buff_st_idx in buffer_starts:
     chk_st_idx = max(0, buff_st_idx - overlap_len)
     buff_nd_idx = min(max_len, buff_st_idx + buffer_len)
-    chk_nd_idx = min(x.size, buff_nd_idx + overlap_len)
+    chk_nd_idx = min(x.shape[0], buff_nd_idx + overlap_len)
     rel_st_idx = buff_st_idx - chk_st_idx
     rel_nd_idx = buff_nd_idx - chk_st_idx
-    this_y_chk = filtfilt(b, a, x[chk_st_idx:chk_nd_idx])
+    if isinstance(coeffs, tuple):
+      this_y_chk = filtfilt(coeffs[0], coeffs[1], x[chk_st_idx:chk_nd_idx], axis=0)
+    else:
+      this_y_chk = sosfiltfilt(coeffs, x[chk_st_idx:chk_nd_idx], axis=0)
     y[buff_st_idx:buff_nd_idx] = this_y_chk[rel_st_idx:rel_nd_idx]
+  return y
+
+def zero_phase_long(finname, foutname, fmt, coeffs, buffer_len, overlap_len, max_len, processes, n_channels, offset):
+  """The chunked filtering for filtfiltlong and sosfiltfiltlong. coeffs is a (b, a) tuple or an sos array"""
+  if overlap_len is None:
+    overlap_len = impulse_len(coeffs)
+    logger.info('Overlap {:d} samples'.format(overlap_len))
+  x = memmap_channels(finname, fmt, n_channels, offset)
+  if max_len == -1:
+    max_len = x.shape[0]
+  y = memmap_channels(foutname, fmt, n_channels, mode='w+', n_samples=max_len)
+  buffer_starts = range(0, max_len, buffer_len)
+
+  if processes == 1 or len(buffer_starts) < 2:
+    return filtfiltarray(x, y, coeffs, buffer_len, overlap_len)
+
+  y.flush()
+  del y
+  from multiprocessing import Pool, cpu_count
+  n_jobs = min(len(buffer_starts), 4 * (processes or cpu_count())) #A few jobs per process balances the load
+  jobs = [(finname, foutname, fmt, coeffs, buffer_starts[n::n_jobs], buffer_len, overlap_len, max_len, n_channels,
+           offset) for n in xrange(n_jobs)]
+  pool = Pool(processes=processes)
+  pool.map(filtfilt_job, jobs)
+  pool.close()
+  pool.join()
+  return memmap_channels(foutname, fmt, n_channels, mode='r+', n_samples=max_len)
+
+def filtfilt_job(args):
+  """Worker for zero_phase_long: filter a list of buffers, writing into this process' own memmap of the output file"""
+  finname, foutname, fmt, coeffs, buffer_starts, buffer_len, overlap_len, max_len, n_channels, offset = args
+  x = memmap_channels(finname, fmt, n_channels, offset)
+  y = memmap_channels(foutname, fmt, n_channels, mode='r+', n_samples=max_len)
+  filtfiltarray(x, y, coeffs, buffer_len, overlap_len, buffer_starts)
+  y.flush()
+
+sos_cache = {}
+
+def design_sos(fs, fl, fh, gpass, gstop, ftype='butter'):
+  """Design a bandpass filter with the same band edge conventions as butterfilt, but return it as second order
+  sections, which are numerically well behaved even for high order filters. Designs are cached (in sos_cache), so
+  asking for the same filter again, e.g. once per channel, is free. Each call returns its own copy."""
+  fso2 = fs/2.0
+  wp = [fl/fso2, fh/fso2]
+  ws = [0.8*fl/fso2,1.4*fh/fso2]
+  key = (fs, fl, fh, gpass, gstop, ftype)
+  if key not in sos_cache:
+    sos_cache[key] = iirdesign(wp, ws, gpass=gpass, gstop=gstop, ftype=ftype, output='sos')
+  return sos_cache[key].copy()
+
+
+class StreamFilter:
+  """A causal (forward only) sos filter that is fed successive blocks of data and carries the filter state across the
+  block boundaries, so that filtering a file block by block gives the same result as filtering it in one go. Blocks
+  are 1-D or (samples x channels), filtered along axis 0.
+
+  Unlike filtfiltlong this does not give zero phase filtering: the output lags the input by the group delay of the
+  filter. The state is initialized to the steady state response to the first sample, to avoid a start up transient."""
+  def __init__(self, sos):
+    self.sos = sos
+    self.zi = None
+
+  def filter(self, x):
+    x = pylab.asarray(x, dtype=float)
+    if self.zi is None:
+      zi = sosfilt_zi(self.sos)
+      self.zi = zi.reshape(zi.shape + (1,)*(x.ndim-1)) * x[0]
+    y, self.zi = sosfilt(self.sos, x, axis=0, zi=self.zi)
+    return y
+
+
+class Decimator:
+  """Anti-aliased downsampling by an integer factor for data that comes in successive blocks. The anti-aliasing
+  filter is a linear phase FIR lowpass (cutoff at the new Nyquist frequency) run as a polyphase filter (upfirdn), so
+  only the output samples we keep are computed. The input samples the filter still needs are carried over from one
+  block to the next, so decimating a file block by block gives the same result as decimating it in one go.
+
+  The filter has n_per_phase*q + 1 taps. With n_per_phase even, its delay is a whole number of output samples and is
+  taken out: output sample m lines up with input sample m*q, as with slicing x[::q], and there is no phase shift. The
+  price is that the output lags the input by n_per_phase/2 output samples, which are emitted by flush().
+  Inputs:
+    q           - decimation factor
+    n_per_phase - filter taps per output sample (even). More taps give a sharper anti-aliasing filter
+  """
+  def __init__(self, q, n_per_phase=20):
+    if n_per_phase % 2:
+      raise ValueError('n_per_phase must be even')
+    self.q = q
+    self.h = firwin(n_per_phase*q + 1, 1.0/q, window='hamming')
+    self.delay = n_per_phase*q//2 #Taps on either side of the centre tap, a multiple of q
+    self.history = None #Input samples still needed. Always starts at an input index that is a multiple of q
+    self.n_in = 0
+    self.n_out = 0
+
+  def process(self, x):
+    """x - 1-D or (samples x channels) block. Returns the decimated samples we can compute so far"""
+    x = pylab.asarray(x, dtype=float)
+    if self.history is None:
+      self.history = pylab.zeros((self.delay,) + x.shape[1:]) #The data is taken to be zero before the start
+    self.n_in += x.shape[0]
+    return self.decimate_buffer(pylab.concatenate((self.history, x)))
+
+  def flush(self):
+    """Return the last decimated samples, treating the data as zero after the end. Call once, after the last block"""
+    if self.history is None:
+      return pylab.zeros(0)
+    n_left = -(-self.n_in // self.q) - self.n_out
+    tail = pylab.zeros((self.delay,) + self.history.shape[1:])
+    return self.decimate_buffer(pylab.concatenate((self.history, tail)))[:n_left]
+
+  def decimate_buffer(self, buf):
+    #The first output whose taps are all in buf is full convolution sample 2*delay, which is polyphase output
+    #2*delay/q. Every q th input sample after that with all its taps in buf is an output
+    n = max(0, (buf.shape[0] - 1 - 2*self.delay) // self.q + 1)
+    k = 2*self.delay // self.q
+    y = upfirdn(self.h, buf, 1, self.q, axis=0)[k:k + n]
+    self.history = buf[n*self.q:]
+    self.n_out += n
+    return y
+
+
+def decimatelong(finname, foutname, fmt, q, n_per_phase=20, buffer_len=100000, max_len=-1, n_channels=1, offset=0):
+  """Use memmap and chunking to decimate continuous data, e.g. the LFP band written by butterfilt or filtfiltlong.
+  Inputs:
+    finname, foutname, fmt - as for filtfiltlong
+    q           - decimation factor
+    n_per_phase - anti-aliasing filter taps per output sample (see Decimator)
+    buffer_len  - how much data to process at a time
+    max_len     - how many input samples to process. If set to -1, processes the whole file
+    n_channels, offset - for channel interleaved files with a header (see filtfiltlong)
+  Outputs:
+    y           - The memmapped array pointing to the written file. It has ceil(max_len/q) samples, sample m
+                  corresponding to input sample m*q
+  """
+  x = memmap_channels(finname, fmt, n_channels, offset)
+  if max_len == -1:
+    max_len = x.shape[0]
+  y = memmap_channels(foutname, fmt, n_channels, mode='w+', n_samples=-(-max_len // q))
+  dec = Decimator(q, n_per_phase)
+  n_out = 0
+  for buff_st_idx in xrange(0, max_len, buffer_len):
+    this_y = dec.process(x[buff_st_idx:min(max_len, buff_st_idx + buffer_len)])
+    y[n_out:n_out + this_y.shape[0]] = this_y
+    n_out += this_y.shape[0]
+  y[n_out:] = dec.flush()
+  return y
+
+
+def quantize(y, fmt):
+  """Convert filtered data to fmt for writing out. For integer formats the data is rounded and clipped to the range of
+  the format, rather than truncated and wrapped around"""
+  fmt = pylab.dtype(fmt)
+  if fmt.kind in 'iu':
+    info = pylab.iinfo(fmt)
+    y = pylab.clip(pylab.round_(y), info.min, info.max)
+  return y.astype(fmt)
+
+
+class BandSplitter:
+  """Pipeline stage that splits blocks of multichannel raw data into an LFP band, which is decimated, and a spike band,
+  writing each channel out to its own file in the same raw format extract_nrd uses. It is meant to be handed to
+  lynxio.extract_nrd_ec (or extract_nrd_fast) so that the filtering is done on each block while it is still in memory,
+  instead of writing out the raw channels and reading them back in to filter them.
+
+  Inputs:
+    fs - sampling frequency of the raw data
+    flfpname - list of file names for the LFP band of each channel (None to skip the LFP)
+    fspikename - list of file names for the spike band of each channel (None to skip the spike band)
+    lfp, spike - dictionaries with the band ('fl', 'fh') and ripple ('gpass', 'gstop') settings, e.g. the presets
+    lfp_decimate - decimation factor for the LFP band (see Decimator)
+    fmt - format of the output data
+
+  The filters are causal (see StreamFilter). The decimated LFP runs n_per_phase/2 samples behind the input and the
+  last of it is written out by close()."""
+  def __init__(self, fs, flfpname, fspikename, lfp=lynxlfp, spike=lynxspike, lfp_decimate=32, fmt='i'):
+    self.fmt = fmt
+    self.lfp_filter = self.spike_filter = None
+    self.flfp = self.fspike = []
+    if flfpname is not None:
+      self.lfp_filter = StreamFilter(design_sos(fs, lfp['fl'], lfp['fh'], lfp['gpass'], lfp['gstop']))
+      self.decimator = Decimator(lfp_decimate)
+      self.flfp = [open(fn, 'wb') for fn in flfpname]
+    if fspikename is not None:
+      self.spike_filter = StreamFilter(design_sos(fs, spike['fl'], spike['fh'], spike['gpass'], spike['gstop']))
+      self.fspike = [open(fn, 'wb') for fn in fspikename]
+
+  def process(self, block):
+    """block - (samples x channels) array"""
+    if self.lfp_filter is not None:
+      self.write_lfp(self.decimator.process(self.lfp_filter.filter(block)))
+    if self.spike_filter is not None:
+      self.write_channels(self.spike_filter.filter(block), self.fspike)
+
+  def write_lfp(self, y):
+    self.write_channels(y, self.flfp)
+
+  def write_channels(self, y, files):
+    y = quantize(y, self.fmt)
+    for n, fout in enumerate(files):
+      y[:,n].tofile(fout)
 
-  return y
\ No newline at end of file
+  def close(self):
+    if self.lfp_filter is not None and self.decimator.n_in:
+      self.write_lfp(self.decimator.flush())
+    [fout.close() for fout in self.flfp + self.fspike]
@@ -0,0 +1,229 @@
+"""Detect saccades, fixations and blinks in eye position traces with a velocity threshold.
+
+The detector works on a whole session at a time: the eye samples of all the trials are held in one contiguous array
+per axis, with an array of trial offsets (see neurapy.utility.ragged). Velocity is computed with a single
+smoothing differentiator (a least squares slope over a short window) run over the whole buffer. Samples whose window
+would straddle a trial boundary are marked invalid, so events never run from one trial into the next.
+
+Events are returned as structured arrays, one row per event, with the trial number and the start and stop sample
+(within the trial, python slice style) of the event.
+
+e.g.
+  from neurapy.lablib import eye
+  from neurapy.utility import eyemovements as em
+  M, C = eye.eye_calibrations(R)
+  X, Y = eye.eye_xy_ragged(R, M, C)
+  ev = em.detect(X, Y, fs=200.0)
+  ev['saccades']['peak velocity']
+
+  bhv = bhv_read.read_bhv(fname)
+  ev = em.detect(bhv['XEye'], bhv['YEye'], fs=bhv['AnalogInputFrequency'])
+
+  #Many sessions, in parallel
+  events = em.detect_files(fnames, em.load_bhv_eye, processes=8)
+"""
+import logging, pylab
+from multiprocessing import Pool
+from neurapy.utility.ragged import RaggedArray, from_list
+logger = logging.getLogger(__name__)
+
+saccade_dtype = [('trial', 'i4'), ('start', 'i8'), ('stop', 'i8'), ('duration', 'f8'), ('peak velocity', 'f8'),
+                 ('amplitude', 'f8'), ('x0', 'f8'), ('y0', 'f8'), ('x1', 'f8'), ('y1', 'f8')]
+fixation_dtype = [('trial', 'i4'), ('start', 'i8'), ('stop', 'i8'), ('duration', 'f8'), ('x', 'f8'), ('y', 'f8'),
+                  ('dispersion', 'f8')]
+blink_dtype = [('trial', 'i4'), ('start', 'i8'), ('stop', 'i8'), ('duration', 'f8')]
+
+
+def derivative_kernel(fs, window_ms=20.0):
+  """Convolution kernel that returns the least squares slope (units/s) over a window of 2m+1 samples. This smooths
+  and differentiates in one step.
+
+  Inputs:
+    fs - sampling rate (Hz)
+    window_ms - width of the window (ms). At least 3 samples are used
+  Outputs:
+    kernel - 2m+1 array, for use with convolve(x, kernel, mode='same')
+  """
+  m = max(1, int(round(window_ms * fs / 2000.0)))
+  k = pylab.arange(-m, m + 1, dtype=float)
+  return k[::-1] * fs / (k**2).sum() #Reversed, since convolve flips the kernel
+
+
+def velocity(x, y, offsets, fs, window_ms=20.0):
+  """Eye speed for all the samples of a session.
+
+  Inputs:
+    x, y - contiguous eye position arrays (deg)
+    offsets - trial offsets: the samples of trial tr are x[offsets[tr]:offsets[tr+1]]
+    fs - sampling rate (Hz)
+    window_ms - width of the differentiating window (ms)
+  Outputs:
+    vx, vy - velocity (deg/s)
+    valid - False for samples too close to a trial boundary to have a velocity
+  """
+  kernel = derivative_kernel(fs, window_ms)
+  m = kernel.size // 2
+  vx = pylab.convolve(x, kernel, mode='same')
+  vy = pylab.convolve(y, kernel, mode='same')
+  pos = RaggedArray(x, offsets).position()
+  n = pylab.repeat(pylab.diff(offsets), pylab.diff(offsets))
+  valid = (pos >= m) & (pos < n - m) & pylab.isfinite(vx) & pylab.isfinite(vy)
+  return vx, vy, valid
+
+
+def runs(mask, offsets):
+  """Find the runs of True in mask, without letting a run cross a trial boundary.
+
+  Inputs:
+    mask - boolean array over the whole session
+    offsets - trial offsets
+  Outputs:
+    starts, stops - sample index (into the session buffer) of the start and one past the end of each run
+  """
+  nonempty = pylab.diff(offsets) > 0
+  at_start = pylab.zeros(mask.size, dtype=bool)
+  at_start[offsets[:-1][nonempty]] = True
+  at_end = pylab.zeros(mask.size, dtype=bool)
+  at_end[offsets[1:][nonempty] - 1] = True
+  prev = pylab.concatenate(([False], mask[:-1]))
+  nxt = pylab.concatenate((mask[1:], [False]))
+  starts = pylab.flatnonzero(mask & (~prev | at_start))
+  stops = pylab.flatnonzero(mask & (~nxt | at_end)) + 1
+  return starts, stops
+
+
+def segment_reduce(ufunc, a, starts, stops):
+  """ufunc.reduce over each a[starts[i]:stops[i]] (non empty segments) in one call"""
+  if starts.size == 0:
+    return pylab.zeros(0, dtype=a.dtype)
+  idx = pylab.column_stack((starts, stops)).ravel()
+  return ufunc.reduceat(pylab.concatenate((a, [0])), idx)[::2]
+
+
+def event_table(dtype, starts, stops, offsets, fs):
+  ev = pylab.zeros(starts.size, dtype=dtype)
+  trial = pylab.searchsorted(offsets, starts, side='right') - 1
+  ev['trial'] = trial
+  ev['start'] = starts - offsets[trial]
+  ev['stop'] = stops - offsets[trial]
+  ev['duration'] = (stops - starts) * 1000.0 / fs
+  return ev
+
+
+def detect(X, Y, fs, threshold=30.0, window_ms=20.0, min_saccade_ms=10.0, min_fixation_ms=50.0,
+           min_blink_ms=0.0, blink_limit=None):
+  """Classify the eye samples of a session into saccades, fixations and blinks.
+
+  Inputs:
+    X, Y - eye position (deg) as RaggedArrays (e.g. from lablib.eye.eye_xy_ragged) or lists of per trial arrays
+           (e.g. bhv['XEye'])
+    fs - sampling rate (Hz)
+    threshold - saccade speed threshold (deg/s)
+    window_ms - width of the differentiating window (ms)
+    min_saccade_ms, min_fixation_ms, min_blink_ms - shorter events are dropped
+    blink_limit - samples with |x| or |y| above this (deg) are taken as blinks (eye lost), as are non finite samples
+  Outputs:
+    dictionary with structured arrays
+      'saccades' - trial, start, stop, duration (ms), peak velocity (deg/s), amplitude (deg), x0, y0, x1, y1
+      'fixations' - trial, start, stop, duration (ms), x, y (mean position), dispersion (rms distance from the mean)
+      'blinks' - trial, start, stop, duration (ms)
+    start and stop are sample indexes within the trial
+  """
+  if not isinstance(X, RaggedArray):
+    X = from_list(X, dtype=float)
+  if not isinstance(Y, RaggedArray):
+    Y = from_list(Y, dtype=float)
+  if (X.lengths() != Y.lengths()).any():
+    raise ValueError('x and y have different numbers of samples')
+  x = pylab.asarray(X.data, dtype=float)
+  y = pylab.asarray(Y.data, dtype=float)
+  offsets = X.offsets - X.offsets[0]
+
+  lost = ~(pylab.isfinite(x) & pylab.isfinite(y))
+  if blink_limit is not None:
+    with pylab.errstate(invalid='ignore'):
+      lost |= (abs(x) > blink_limit) | (abs(y) > blink_limit)
+  #Don't let lost samples spill into the velocity of their neighbours
+  x = pylab.where(lost, pylab.nan, x)
+  y = pylab.where(lost, pylab.nan, y)
+  vx, vy, valid = velocity(x, y, offsets, fs, window_ms)
+  speed = pylab.hypot(vx, vy)
+  speed[~valid] = 0
+
+  starts, stops = runs(lost, offsets)
+  keep = (stops - starts) * 1000.0 / fs >= min_blink_ms
+  blinks = event_table(blink_dtype, starts[keep], stops[keep], offsets, fs)
+
+  is_saccade = valid & (speed > threshold)
+  starts, stops = runs(is_saccade, offsets)
+  keep = (stops - starts) * 1000.0 / fs >= min_saccade_ms
+  starts, stops = starts[keep], stops[keep]
+  saccades = event_table(saccade_dtype, starts, stops, offsets, fs)
+  saccades['peak velocity'] = segment_reduce(pylab.maximum, speed, starts, stops)
+  saccades['x0'], saccades['y0'] = x[starts], y[starts]
+  saccades['x1'], saccades['y1'] = x[stops - 1], y[stops - 1]
+  saccades['amplitude'] = pylab.hypot(saccades['x1'] - saccades['x0'], saccades['y1'] - saccades['y0'])
+
+  is_fixation = valid & ~is_saccade
+  starts, stops = runs(is_fixation, offsets)
+  keep = (stops - starts) * 1000.0 / fs >= min_fixation_ms
+  starts, stops = starts[keep], stops[keep]
+  fixations = event_table(fixation_dtype, starts, stops, offsets, fs)
+  n = stops - starts
+  fixations['x'] = segment_reduce(pylab.add, x, starts, stops) / n
+  fixations['y'] = segment_reduce(pylab.add, y, starts, stops) / n
+  ss = segment_reduce(pylab.add, x**2 + y**2, starts, stops) / n
+  fixations['dispersion'] = pylab.sqrt(pylab.maximum(ss - fixations['x']**2 - fixations['y']**2, 0))
+
+  return {'saccades': saccades, 'fixations': fixations, 'blinks': blinks}
+
+
+def load_bhv_eye(fname):
+  """Loader for detect_files: eye position and sampling rate from a MonkeyLogic .bhv file"""
+  from neurapy.monkeylogic import bhv_read
+  bhv = bhv_read.read_bhv(fname=fname)
+  return bhv['XEye'], bhv['YEye'], bhv['AnalogInputFrequency']
+
+
+def load_lablib_eye(fname, f_samp=200.0):
+  """Loader for detect_files: calibrated eye position from a lablib .dat file or session directory"""
+  from neurapy.lablib import eye, lablib, session
+  if fname.endswith('.dat'):
+    R = lablib.LLColumnarReader(fname=fname)
+  else:
+    R = session.load_session(fname)
+  M, C = eye.eye_calibrations(R)
+  X, Y = eye.eye_xy_ragged(R, M, C)
+  return X, Y, f_samp
+
+
+def detect_file(args):
+  """Worker for detect_files"""
+  fname, loader, kwargs = args
+  try:
+    X, Y, fs = loader(fname)
+    return detect(X, Y, fs, **kwargs)
+  except Exception as e:
+    logger.error('{:s}: {:s}'.format(fname, str(e)))
+    return None
+
+
+def detect_files(fnames, loader, processes=None, **kwargs):
+  """Run detect on many sessions, one process per session.
+
+  Inputs:
+    fnames - list of files
+    loader - module level function fname -> (X, Y, fs), e.g. load_bhv_eye or load_lablib_eye
+    processes - number of worker processes. None uses all the cores, 1 runs in this process
+    kwargs - passed on to detect
+  Outputs:
+    list of event dictionaries (see detect), None for files that failed
+  """
+  jobs = [(fname, loader, kwargs) for fname in fnames]
+  if processes == 1:
+    return [detect_file(job) for job in jobs]
+  pool = Pool(processes=processes)
+  events = pool.map(detect_file, jobs)
+  pool.close()
+  pool.join()
+  return events
@@ -0,0 +1,79 @@
+"""A ragged array is a list of arrays of different lengths (e.g. the eye samples of each trial) stored as one
+contiguous array plus an array of offsets. Element i is data[offsets[i]:offsets[i+1]]. Whole session operations can be
+done on data in one go, while per trial access returns views, not copies.
+
+e.g.
+  from neurapy.utility.ragged import RaggedArray, from_list
+  X = from_list([x0, x1, x2])
+  X[1] -> x1 (a view into X.data)
+  X.data.mean() -> mean over all trials
+"""
+import pylab
+
+
+class RaggedArray:
+  def __init__(self, data, offsets):
+    """
+    Inputs:
+      data - the concatenated elements
+      offsets - n+1 array. Element i is data[offsets[i]:offsets[i+1]]
+    """
+    self.data = data
+    self.offsets = pylab.asarray(offsets, dtype='i8')
+
+  def __len__(self):
+    return self.offsets.size - 1
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if i < 0 or i >= len(self):
+      raise IndexError('ragged array index out of range')
+    return self.data[self.offsets[i]:self.offsets[i+1]]
+
+  def lengths(self):
+    return pylab.diff(self.offsets)
+
+  def row_index(self):
+    """The element (row) each entry of data belongs to"""
+    return pylab.repeat(pylab.arange(len(self)), self.lengths())
+
+  def position(self):
+    """The position of each entry of data within its element"""
+    return pylab.arange(self.offsets[-1] - self.offsets[0]) - pylab.repeat(self.offsets[:-1] - self.offsets[0],
+                                                                           self.lengths())
+
+  def tolist(self):
+    """List of views, one per element"""
+    return [self[i] for i in xrange(len(self))]
+
+
+def from_list(arrays, dtype=None):
+  """Pack a list of arrays (or lists) into a RaggedArray. The data is copied once."""
+  lengths = [len(a) for a in arrays]
+  offsets = pylab.concatenate(([0], pylab.cumsum(lengths))).astype('i8')
+  if len(arrays):
+    data = pylab.concatenate([pylab.asarray(a, dtype=dtype) for a in arrays])
+  else:
+    data = pylab.zeros(0, dtype=dtype or float)
+  return RaggedArray(data, offsets)
+
+
+def range_index(starts, stops):
+  """Indexes of all the ranges start[i]:stop[i] concatenated, without a python loop. Empty ranges (stop <= start) are
+  skipped.
+
+  Inputs:
+    starts, stops - arrays of start and stop indexes
+  Outputs:
+    idx - concatenated indexes
+    lengths - number of indexes from each range
+  """
+  starts = pylab.asarray(starts, dtype='i8')
+  lengths = pylab.maximum(pylab.asarray(stops, dtype='i8') - starts, 0)
+  n = lengths.sum()
+  if n == 0:
+    return pylab.zeros(0, dtype='i8'), lengths
+  range_offsets = pylab.cumsum(lengths) - lengths
+  idx = pylab.arange(n) - pylab.repeat(range_offsets - starts, lengths)
+  return idx, lengths